@@ -24,6 +24,8 @@ import tensorflow as tf
 from convnetshared1 import NNModel
 from convnetshared1 import LSTMModel
 from data_model import TrainingData
+import frozen_model
+import numpy_engine
 from html_output import HtmlDebug
 
 import sys,os
@@ -207,6 +209,9 @@ while iteration < 1000*128:
             if cool_score < best_total_score:
               best_total_score = cool_score
               save_path = saver.save(sess, os.path.join(output_path, "model.ckpt"))
+              # The car loads the frozen inference graph or the numpy weights next to the checkpoint.
+              frozen_model.export(save_path)
+              numpy_engine.export(save_path)
               config.store('last_tf_model', save_path)
               print("Saved: " + str(cool_score))
 
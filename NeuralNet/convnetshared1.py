@@ -49,20 +49,30 @@ class NNModel:
     n_hidden = 128  # hidden layer num of features
     # n_vocab = 256
 
-    def __init__(self):
+    # Names of the graph's inputs and outputs, for freezing and loading the inference graph.
+    input_names = ['in_image', 'in_speed']
+    output_names = ['steering_regress_result', 'throttle_regress_result']
+
+    def __init__(self, inference_only=False):
+        """inference_only builds just the image and speed inputs and the steering
+        and throttle outputs: no labels, loss, regularizers, optimizer or dropout.
+        Checkpoints from training restore into it (the Adam slots are skipped).
+        """
+        self.inference_only = inference_only
         self.l2_collection = []
         self.visualizations = {}
 
         # Set up the inputs to the conv net
         self.in_image = tf.placeholder(tf.float32, shape=[None, config.width * config.height * config.img_channels], name='in_image')
-        self.in_image_small = tf.placeholder(tf.float32, shape=[None, config.width_small * config.height_small * config.img_channels], name='in_image_small')
         self.in_speed = tf.placeholder(tf.float32, shape=[None], name='in_speed')
-        # Labels
-        self.steering_regress_ = tf.placeholder(tf.float32, shape=[None], name='steering_regress_')
-        self.throttle_regress_ = tf.placeholder(tf.float32, shape=[None], name='throttle_regress_')
-        # misc
-        self.keep_prob = tf.placeholder(tf.float32)
-        self.train_mode = tf.placeholder(tf.float32)
+        if not inference_only:
+            self.in_image_small = tf.placeholder(tf.float32, shape=[None, config.width_small * config.height_small * config.img_channels], name='in_image_small')
+            # Labels
+            self.steering_regress_ = tf.placeholder(tf.float32, shape=[None], name='steering_regress_')
+            self.throttle_regress_ = tf.placeholder(tf.float32, shape=[None], name='throttle_regress_')
+            # misc
+            self.keep_prob = tf.placeholder(tf.float32)
+            self.train_mode = tf.placeholder(tf.float32)
 
         # Reshape and put input image in range [-0.5..0.5]
         x_image = tf.reshape(self.in_image, [-1, config.width, config.height, config.img_channels])  / 255.0 - 0.5
@@ -96,9 +106,11 @@ class NNModel:
 
         # pick apart the final output matrix into steering and throttle continuous values.
         slice_a = 1
-        self.steering_regress_result = tf.reshape(final_activations[:, 0:slice_a], [-1])
+        self.steering_regress_result = tf.reshape(final_activations[:, 0:slice_a], [-1], name='steering_regress_result')
         slice_b = slice_a + 1
-        self.throttle_regress_result = tf.reshape(final_activations[:, slice_a:slice_b], [-1])
+        self.throttle_regress_result = tf.reshape(final_activations[:, slice_a:slice_b], [-1], name='throttle_regress_result')
+        if inference_only:
+            return
 
         # we will optimized to minimize mean squared error
         self.squared_diff = tf.reduce_mean(tf.squared_difference(self.steering_regress_result, self.steering_regress_))
@@ -133,7 +145,7 @@ class NNModel:
         self.l2_collection.append(W_fc)
         b_fc = bias_variable([channels_out], name='b_' + name, coll=scope_name)
         h_fc = tf.nn.relu(tf.matmul(tensor, W_fc) + b_fc)
-        if dropout:
+        if dropout and not self.inference_only:
             h_fc = tf.nn.dropout(h_fc, self.keep_prob)
         return h_fc
 
@@ -1,11 +1,9 @@
-import tensorflow as tf
 import math
 import numpy as np
 import random
 import os
 
 import config
-import convnetshared1 as convshared
 
 class TrainingData:
     batch_size = 64
@@ -40,26 +38,6 @@ class TrainingData:
 
         return obj
 
-    @classmethod
-    def FromRealLife(cls, image, odo_ticks, vel):
-        obj = cls()
-        image = image.ravel()  # flatten the shape of the tensor.
-        image = image[np.newaxis]  # make a batch of size 1.
-        obj.pic_array = image
-        assert False  # add small pic array
-        size = len(obj.pic_array)
-        assert size == 1
-
-        obj.pic_array_small = np.zeros((size, config.width_small * config.height_small * config.img_channels), dtype=np.float32)  # Placeholder
-        obj.vel_array = np.zeros((size), dtype=np.float32)
-        obj.vel_array[0] = vel
-
-        # Allocate one-hot arrays for labels
-        obj.steer_array = np.zeros((size), dtype=np.float32)
-        obj.throttle_array = np.zeros((size), dtype=np.float32)
-
-        return obj
-
     def GenBatch(self, randIndexes):
         batch_xs = [self.pic_array[index] for index in randIndexes]
         batch_xs_small = [self.pic_array_small[index] for index in randIndexes]
@@ -120,3 +98,64 @@ class TrainingData:
         result.throttle_array = np.array(batch_ys_regress_throttle)
         return result
 
+
+class InferenceFeeder:
+    """Feeds camera frames to the model on the car without allocating per frame.
+
+    The input buffers and the feed dict are made once. set_frame() resizes a
+    frame straight into them: 128x128 for in_image, then 16x16 from that for
+    in_image_small if the model has that input. filemash makes the same two
+    sizes in the same order, but with PIL's bilinear filter for both. Here
+    it's cv2's bilinear and then area resampling, so the pixels can differ
+    slightly from the training arrays. run() fetches only the steering and
+    throttle outputs.
+    """
+
+    def __init__(self, net_model, bgr_to_rgb=True):
+        """bgr_to_rgb converts cv2 frames to the RGB order the training pngs are read in."""
+        # Only the car needs cv2, not training with TrainingData.
+        import cv2
+        self.cv2 = cv2
+        self.bgr_to_rgb = bgr_to_rgb
+        self.size = (config.width, config.height)
+        self.size_small = (config.width_small, config.height_small)
+        # uint8 images the resizes write into.
+        self.resized = np.empty((config.height, config.width, config.img_channels), dtype=np.uint8)
+        self.resized_rgb = np.empty_like(self.resized)
+        self.resized_small = np.empty((config.height_small, config.width_small, config.img_channels), dtype=np.uint8)
+        # float32 batches of one for the placeholders, and image shaped views of them.
+        self.pic_array = np.zeros((1, config.width * config.height * config.img_channels), dtype=np.float32)
+        self.pic_array_small = np.zeros((1, config.width_small * config.height_small * config.img_channels), dtype=np.float32)
+        self.vel_array = np.zeros((1), dtype=np.float32)
+        self.pic_view = self.pic_array.reshape(self.resized.shape)
+        self.pic_small_view = self.pic_array_small.reshape(self.resized_small.shape)
+
+        self.feed_dict = {
+            net_model.in_image: self.pic_array,
+            net_model.in_speed: self.vel_array,
+        }
+        # The inference-only and frozen graphs don't have the small image input.
+        self.use_small = getattr(net_model, 'in_image_small', None) is not None
+        if self.use_small:
+            self.feed_dict[net_model.in_image_small] = self.pic_array_small
+        if getattr(net_model, 'keep_prob', None) is not None:
+            self.feed_dict[net_model.keep_prob] = 1.0
+        self.fetches = [net_model.steering_regress_result, net_model.throttle_regress_result]
+
+    def set_frame(self, frame, vel):
+        cv2 = self.cv2
+        cv2.resize(frame, self.size, dst=self.resized)
+        image = self.resized
+        if self.bgr_to_rgb:
+            cv2.cvtColor(self.resized, cv2.COLOR_BGR2RGB, dst=self.resized_rgb)
+            image = self.resized_rgb
+        np.copyto(self.pic_view, image, casting='unsafe')
+        if self.use_small:
+            cv2.resize(image, self.size_small, dst=self.resized_small, interpolation=cv2.INTER_AREA)
+            np.copyto(self.pic_small_view, self.resized_small, casting='unsafe')
+        self.vel_array[0] = vel
+
+    def run(self, sess):
+        """Returns (steering, throttle) for the last frame set, centered on 0."""
+        steering, throttle = sess.run(self.fetches, feed_dict=self.feed_dict)
+        return steering[0], throttle[0]
@@ -1,38 +1,69 @@
 """Turns folders of training data into np arrays.
 
+A folder can also be a session recorded with config.record_format = 'session'.
+
 Usage:
-  filemash.py [<folders>...] [--outdir=<path>] [--gen_test] [--gen_gan]
+  filemash.py [<folders>...] [--outdir=<path>] [--gen_test] [--gen_gan] [--workers=<n>] [--rebuild]
 
 Options:
   --outdir=<path>  where to save output npy files [default: ~/training-data]
   --gen_test  generate test instead of training data
   --gen_gan  generate GAN data instead of training data
+  --workers=<n>  processes to read and augment the images with [default: 1]
+  --rebuild  re-read every folder instead of only new or changed ones
+
+A manifest next to the outputs records each folder's files and rows. On a
+rerun, the images of folders that come first in the same order and haven't
+changed are kept, and only the folders after them are read again.
 
 Examples:
   python filemash.py /my/training/data ~/my/other/data
+  python filemash.py ~/training-images/2017_10_01__01_02_03_PM.session
 """
 
 import os.path
-import math
+import json
+import multiprocessing
+import random
 from docopt import docopt
 from PIL import Image
 import Warp
 import numpy as np
-import collections
 
 import sys,os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
 import config
+import recording_index
+import session_file
+import telemetry_filters
 
 # Parse args.
 args = docopt(__doc__)
 all_folders = args['<folders>']
 
+# Open session readers, by path, for the session frames in this process.
+session_readers = {}
+
+def OpenImage(source):
+    """source is an image file, or a session_file.frame_ref() to a recorded frame."""
+    ref = session_file.parse_frame_ref(source)
+    if ref is None:
+        return Image.open(source)
+    path, index = ref
+    if path not in session_readers:
+        session_readers[path] = session_file.SessionReader(path)
+    # Sessions hold the frames as the car's camera gives them, in BGR order.
+    return Image.fromarray(np.ascontiguousarray(session_readers[path].frame(index)[:, :, ::-1]))
+
+def FileStamp(path):
+    # Session frames never change once they're written.
+    return 0 if session_file.parse_frame_ref(path) is not None else os.path.getmtime(path)
+
 lamecount =0
 def ReadPNG(source, targetWidth, targetHeight, targetWidth2, targetHeight2, train_or_test_or_gan):
     global lamecount
     try:
-        pngfile = Image.open(source)
+        pngfile = OpenImage(source)
         pngfile = pngfile.resize((targetWidth, targetHeight), Image.BILINEAR)
         pngfile = pngfile.crop((0, 0, targetWidth, targetHeight))
         # if (random.random() < 0.5):
@@ -57,135 +88,181 @@ def ReadPNG(source, targetWidth, targetHeight, targetWidth2, targetHeight2, trai
     ret2[:, :, 2] = pixRGB2[:, :, 2]
     return ret, ret2
 
-def is_finite(x):
-    return not math.isnan(x) and not math.isinf(x)
-
-def ParseGoodFloat(s):
+# Images are read in chunks of at most this many, each from a single folder and
+# with its own random seed, so the augmentation doesn't depend on the number of workers.
+CHUNK_SIZE = 256
+
+def MakeChunks(allPNGs, chunk_size=CHUNK_SIZE):
+    """Splits allPNGs, in order, into lists of paths that don't cross folders."""
+    chunks = []
+    for path in allPNGs:
+        if (not chunks or len(chunks[-1]) >= chunk_size or
+                os.path.dirname(chunks[-1][-1]) != os.path.dirname(path)):
+            chunks.append([])
+        chunks[-1].append(path)
+    return chunks
+
+def ReadPNGChunk(chunk_args):
+    # Runs in a worker process. Warp uses both random and np.random.
+    paths, seed, train_or_test_or_gan = chunk_args
+    random.seed(seed)
+    np.random.seed(seed)
+    return [ReadPNG(path, 128, 128, 16, 16, train_or_test_or_gan) for path in paths]
+
+def ReadAllPNGs(allPNGs, train_or_test_or_gan, workers=1, start=0):
+    """Yields ReadPNG's (png, png_small) for each of allPNGs[start:], in order.
+
+    Chunk seeds come from np.random, which __main__ seeds with 1, so the
+    same frames get the same augmentation with any number of workers. start
+    has to be at a folder boundary: the chunks and seeds are still worked out
+    for all of allPNGs, so an incremental run matches a full one.
+    """
+    chunks = MakeChunks(allPNGs)
+    seeds = np.random.randint(0, 2**31 - 1, size=len(chunks))
+    chunk_args = []
+    chunk_start = 0
+    for chunk, seed in zip(chunks, seeds):
+        if chunk_start >= start:
+            chunk_args.append((chunk, int(seed), train_or_test_or_gan))
+        chunk_start += len(chunk)
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        # imap hands results back in chunk order, while the workers run ahead.
+        results = pool.imap(ReadPNGChunk, chunk_args)
+    else:
+        pool = None
+        results = (ReadPNGChunk(a) for a in chunk_args)
     try:
-        a = float(s)
-        if is_finite(a):
-            return float(a)
-        else:
-            return 0.0
-    except ValueError:
-        return 0.0
-
-
-# Fix places where our crappy remote control is dropping signal. Hacky.
-def FixBadSignal(arr, index):
-    if index <= 1: return False
-    if index >= len(arr) - 2: return False
-    a = arr[index - 1]
-    b = arr[index]
-    c = arr[index + 1]
-    da = abs(b-a)
-    db = abs(c-b)
-    # if (da > 45) and (db > 45) and (b < a) and (b < c):
-    # if ((b == 0) and (b < a) and (b < c)) or ((b >= 170) and (b > a) and (b < c)):
-    if (b == 0) or (b >= 179):
-        arr[index] = arr[index - 1]
-        print("fixed: " + str(index) + "  " + str(a) + " " + str(b) + " " + str(c))
-
-def FixVeryBadSignal(arr, index):
-    if index <= 2: return False
-    if index >= len(arr) - 3: return False
-    a = arr[index - 1]
-    b = arr[index]
-    c = arr[index + 1]
-    d = arr[index + 2]
-    da = abs(b-a)
-    db = abs(d-c)
-    # if (da > 45) and (db > 45) and (b < a) and (c < d):
-    # if ((b == 0) and (b < a) and (b < c)) or ((b >= 170) and (b > a) and (b < c)):
-    if (b == 0) or (b >= 179):
-        arr[index] = arr[index - 1]
-        arr[index + 1] = arr[index + 2]
-        print("fixed bad: " + str(index) + "  " + str(a) + " " + str(b) + " " + str(c) + " " + str(d))
-
+        for chunk_result in results:
+            for result in chunk_result:
+                yield result
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+def ManifestPath(outpath, mode):
+    return os.path.join(outpath, mode + "manifest.json")
+
+def FolderManifest(folder, paths, start):
+    """The manifest entry for folder, whose paths are rows start onwards."""
+    return {
+        "folder": os.path.abspath(os.path.expanduser(folder)),
+        "files": [[os.path.basename(path), FileStamp(path)] for path in paths],
+        "rows": [start, start + len(paths)],
+    }
+
+def ReusableRows(outpath, mode, folders):
+    """How many rows at the start of the existing image arrays are still good.
+
+    folders is the new manifest. Rows are kept for the folders at its start
+    that are in the old manifest in the same place, with the same files.
+    """
+    try:
+        with open(ManifestPath(outpath, mode)) as fp:
+            old_folders = json.load(fp)["folders"]
+        rows = min(np.load(os.path.join(outpath, mode + name + ".npy"), mmap_mode='r').shape[0]
+                   for name in ("pic_array", "pic_small_array"))
+    except (IOError, OSError, ValueError, KeyError):
+        return 0
+    keep = 0
+    for old, new in zip(old_folders, folders):
+        if old != new or new["rows"][1] > rows:
+            break
+        keep = new["rows"][1]
+    return keep
+
+def OpenImageArray(path, rows, row_size, keep_rows):
+    """A memory-mapped uint8 .npy of rows rows, at path + ".tmp" until it's
+    renamed into place. Its first keep_rows rows are copied from path.
+    """
+    out = np.lib.format.open_memmap(path + ".tmp", mode='w+', dtype=np.uint8, shape=(rows, row_size))
+    if keep_rows:
+        old = np.load(path, mmap_mode='r')
+        for start in xrange(0, keep_rows, 1024):
+            out[start:min(start + 1024, keep_rows)] = old[start:min(start + 1024, keep_rows)]
+        del old
+    return out
 
 # True for training data generation, False for test data generation
-def GenNumpyFiles(allPNGs, train_or_test_or_gan, slice=None, telemetry=None, do_medfilt=None):
+def GenNumpyFiles(index, train_or_test_or_gan, slice=None, telemetry=None, do_medfilt=None, workers=1,
+                  folder_pngs=None, rebuild=False):
+    """index is the recording_index of every frame, in order. folder_pngs lists
+    (folder, paths) for it, to keep a manifest with. Without it, or with
+    rebuild, every image is read.
+    """
 
-    allNames = [name[name.find("frame_"):] for name in allPNGs]
+    allPNGs = list(index['path'])
+    allNames = [os.path.basename(path) for path in allPNGs]
 
-    processed_pngs = []
-    processed_pngs_small = []
-    all_steering = []
-    all_throttle = []
-    all_odos = []
-    all_vels = []
-    all_millis = []
-    c = collections.Counter()
+    outpath = os.path.expanduser(args['--outdir'])
+    if not os.path.exists(outpath):
+        os.makedirs(outpath)
+    mode = ("train_", "test_", "gan_")[train_or_test_or_gan]
 
-    for i in xrange(len(allNames)):
-        name = allNames[i]
-        s = name.split("_")
+    manifest = None
+    keep_rows = 0
+    if folder_pngs is not None:
+        manifest = []
+        for folder, paths in folder_pngs:
+            manifest.append(FolderManifest(folder, paths, manifest[-1]["rows"][1] if manifest else 0))
+        if not rebuild:
+            keep_rows = ReusableRows(outpath, mode, manifest)
+    print 'keeping %d images from the last run, reading %d' % (keep_rows, len(allNames) - keep_rows)
+
+    # The images go straight into their rows of memory-mapped .npy files, so
+    # memory use doesn't grow with the number of frames. The telemetry is cheap
+    # to parse from the file names, so all of it is redone every time.
+    pic_path = os.path.join(outpath, mode + "pic_array.npy")
+    pic_small_path = os.path.join(outpath, mode + "pic_small_array.npy")
+    processed_pngs = OpenImageArray(pic_path, len(allNames), 128 * 128 * 3, keep_rows)
+    processed_pngs_small = OpenImageArray(pic_small_path, len(allNames), 16 * 16 * 3, keep_rows)
+    images = ReadAllPNGs(allPNGs, train_or_test_or_gan, workers, keep_rows)
+
+    for i in xrange(keep_rows, len(allNames)):
+        if i == keep_rows or ((i % 1024) == 1023):
+            print allNames[i]
 
-        frame = ParseGoodFloat(s[1])
+        # only warp training data, not test.
+        png, png_small = next(images)
+        processed_pngs[i] = png.reshape(-1)
+        processed_pngs_small[i] = png_small.reshape(-1)
 
-        if i  == 0:
-            print name,s
+    # The index parsed the telemetry out of the file names.
+    all_steering = index['ste']
+    all_throttle = index['thr']
+    all_odos = index['odo']
+    # odometer millisecond marks, converted to speed.
+    all_millis = index['mil']
 
-        if ((i % 1024) == 1023):
-            print s
+    # if config.use_throttle_manual_map:
+    #     log_throttle = manual_throttle_map.to_throttle_buckets(throttle)
+    # else:
+    #     log_throttle = do_log_mapping_to_buckets(throttle - 90)
 
-        # only warp training data, not test.
-        png, png_small = ReadPNG(allPNGs[i], 128, 128, 16, 16, train_or_test_or_gan)
-        processed_pngs.append(png.flatten())
-        processed_pngs_small.append(png_small.flatten())
-
-        all_steering.append(ParseGoodFloat(s[5]))
-        all_throttle.append(ParseGoodFloat(s[3]))
-
-        temp_odo = int(s[9].split(".")[0])
-
-        # load odometer millisecond marks and convert to speed.
-        millis = float(s[7])
-        last_odo = 0
-        last_millis = 0
-        if len(all_odos) > config.odo_delta:
-            last_odo = all_odos[-config.odo_delta]
-            last_millis = all_millis[-config.odo_delta]
-        vel = 0
-        if temp_odo != last_odo:
-            if millis - last_millis == 0: vel = 0
-            else: vel = (temp_odo - last_odo) / (millis - last_millis)
-            if (last_millis == 0) and (last_odo == 0): vel = 0
-            if (last_odo >= temp_odo): vel = 0
-
-        # if config.use_throttle_manual_map:
-        #     log_throttle = manual_throttle_map.to_throttle_buckets(throttle)
-        # else:
-        #     log_throttle = do_log_mapping_to_buckets(throttle - 90)
-
-        # steer = int(float(s_ahead[5]))
-        # log_steer = do_log_mapping_to_buckets(steer - 90)
-
-        all_odos.append(temp_odo)
-        all_vels.append(vel)
-        all_millis.append(millis)
+    # steer = int(float(s_ahead[5]))
+    # log_steer = do_log_mapping_to_buckets(steer - 90)
+
+    all_vels = telemetry_filters.odometer_velocity(all_odos, all_millis, config.odo_delta)
 
     # Fix places where our crappy remote control is dropping signal. Hacky.
-    for i in xrange(len(allNames)):
-        FixBadSignal(all_throttle, i)
-        FixVeryBadSignal(all_throttle, i)
-        FixBadSignal(all_steering, i)
-        FixVeryBadSignal(all_steering, i)
-    for i in xrange(len(allNames)):
-        if i > 2:
-            delta = abs(int(all_throttle[i-1]) - int(all_throttle[i]))
-            c.update({delta : 1})
+    fixed_throttle = telemetry_filters.fix_bad_signal(all_throttle)
+    fixed_steering = telemetry_filters.fix_bad_signal(all_steering)
+    print "fixed %d throttle and %d steering values" % (
+        np.count_nonzero(fixed_throttle != all_throttle), np.count_nonzero(fixed_steering != all_steering))
+    all_throttle, all_steering = fixed_throttle, fixed_steering
+    c = telemetry_filters.delta_counts(all_throttle)
     print c
 
-    # Save data.
-    outpath = os.path.expanduser(args['--outdir'])
-    if not os.path.exists(outpath):
-        os.makedirs(outpath)
-    mode = ("train_", "test_", "gan_")[train_or_test_or_gan]
-
+    # Save data. The old manifest goes first, so a crash can't leave it
+    # describing rows that have been replaced.
+    processed_pngs.flush()
+    processed_pngs_small.flush()
+    del processed_pngs, processed_pngs_small
+    if os.path.exists(ManifestPath(outpath, mode)):
+        os.remove(ManifestPath(outpath, mode))
+    for path in (pic_path, pic_small_path):
+        os.rename(path + ".tmp", path)
     data = [
-        (mode + "pic_array", np.array(processed_pngs)),
-        (mode + "pic_small_array", np.array(processed_pngs_small)),
         (mode + "steer_array", np.array(all_steering)),
         (mode + "throttle_array", np.array(all_throttle)),
         (mode + "odo_array", np.array(all_odos)),
@@ -194,28 +271,33 @@ def GenNumpyFiles(allPNGs, train_or_test_or_gan, slice=None, telemetry=None, do_
 
     for d in data:
         np.save(os.path.join(outpath, d[0]), d[1])
-    print 'processed %s images (%d outputs)' % (len(allNames), len(processed_pngs))
+    if manifest is not None:
+        with open(ManifestPath(outpath, mode), 'w') as fp:
+            json.dump({"folders": manifest}, fp)
+    print 'processed %s images (%d read, %d kept)' % (len(allNames), len(allNames) - keep_rows, keep_rows)
     print 'data saved to %s' % outpath
 
 if __name__ == '__main__':
     np.random.seed(1)
 
     # Load all pngs and find filenames.
-    allPNGs = []
+    indexes = []
+    folder_pngs = []
 
     if len(all_folders) == 0:
         all_folders = [config.load('last_record_dir')]
 
     for folder in all_folders:
-        filepaths = [os.path.join(folder, f) for f in os.listdir(folder) if ('.png' in f.lower() or '.jpg' in f.lower()) and (f[0] != '.')]
-
-        allPNGs.extend(sorted(filepaths))
+        index = recording_index.load(folder)
+        indexes.append(index)
+        folder_pngs.append((folder, list(index['path'])))
 
-        print str(len(filepaths))
+        print str(len(index))
 
     train_or_test_or_gan = 0
     if args['--gen_test']: train_or_test_or_gan = 1
     elif args['--gen_gan']: train_or_test_or_gan = 2
 
     print ("Generating TRAINING data.", "Generating TEST data", "Generating GAN data")[train_or_test_or_gan]
-    GenNumpyFiles(allPNGs, train_or_test_or_gan)
+    GenNumpyFiles(recording_index.concatenate(indexes), train_or_test_or_gan, workers=int(args['--workers']),
+                  folder_pngs=folder_pngs, rebuild=args['--rebuild'])
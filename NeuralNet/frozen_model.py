@@ -0,0 +1,153 @@
+"""Freezes a trained checkpoint into an inference-only graph for the car.
+
+The frozen graph only has the image and speed inputs and the steering and
+throttle outputs, with the weights folded in as constants. There's no loss,
+optimizer or Adam slots, so it loads faster and each sess.run does less.
+It's written next to the checkpoint as <checkpoint>_frozen.pb (model.ckpt ->
+model_frozen.pb), where main_car.py looks for it.
+
+Usage:
+  frozen_model.py export [<checkpoint>] [--runs=<n>]
+  frozen_model.py bench [<checkpoint>] [--runs=<n>]
+
+Options:
+  --runs=<n>  sess.run calls to time for each graph [default: 200]
+
+If no checkpoint is given, the last trained model is used.
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.framework import graph_util
+from tensorflow.python.tools import optimize_for_inference_lib
+
+from convnetshared1 import NNModel
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import config
+
+
+def frozen_path(checkpoint_path):
+    return os.path.splitext(checkpoint_path)[0] + '_frozen.pb'
+
+
+def find_frozen(checkpoint_path):
+    """Returns the frozen graph for checkpoint_path, or None if it hasn't been
+    exported or is older than the checkpoint.
+    """
+    path = frozen_path(checkpoint_path)
+    if not os.path.exists(path):
+        return None
+    index_path = checkpoint_path + '.index'
+    if os.path.exists(index_path) and os.path.getmtime(index_path) > os.path.getmtime(path):
+        return None
+    return path
+
+
+def export(checkpoint_path, out_path=None):
+    """Restores checkpoint_path into an inference-only NNModel and writes the
+    pruned, constant-folded graph. Returns the path written.
+    """
+    out_path = out_path or frozen_path(checkpoint_path)
+    with tf.Graph().as_default() as graph:
+        NNModel(inference_only=True)
+        with tf.Session(graph=graph) as sess:
+            # Only the model weights are in this graph, so the Adam slots in the checkpoint are skipped.
+            tf.train.Saver().restore(sess, checkpoint_path)
+            graph_def = graph_util.convert_variables_to_constants(
+                sess, graph.as_graph_def(), NNModel.output_names)
+    graph_def = optimize_for_inference_lib.optimize_for_inference(
+        graph_def, NNModel.input_names, NNModel.output_names, tf.float32.as_datatype_enum)
+    with tf.gfile.GFile(out_path, 'wb') as fp:
+        fp.write(graph_def.SerializeToString())
+    return out_path
+
+
+class FrozenModel(object):
+    """A frozen graph loaded for inference, with the same tensors do_tensorflow
+    uses on NNModel. Run it in a session made with graph=model.graph.
+    """
+
+    def __init__(self, path):
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(path, 'rb') as fp:
+            graph_def.ParseFromString(fp.read())
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        self.in_image = self.graph.get_tensor_by_name('in_image:0')
+        self.in_speed = self.graph.get_tensor_by_name('in_speed:0')
+        self.steering_regress_result = self.graph.get_tensor_by_name('steering_regress_result:0')
+        self.throttle_regress_result = self.graph.get_tensor_by_name('throttle_regress_result:0')
+
+
+def _load_checkpoint(checkpoint_path, inference_only):
+    graph = tf.Graph()
+    with graph.as_default():
+        model = NNModel(inference_only=inference_only)
+        sess = tf.Session(graph=graph)
+        tf.train.Saver().restore(sess, checkpoint_path)
+    return sess, model
+
+
+def _load_frozen(path):
+    model = FrozenModel(path)
+    return tf.Session(graph=model.graph), model
+
+
+def _time_runs(sess, model, runs):
+    image = np.random.RandomState(1).randint(0, 256, (1, config.width * config.height * config.img_channels)).astype(np.float32)
+    speed = np.zeros(1, dtype=np.float32)
+    fetches = [model.steering_regress_result, model.throttle_regress_result]
+    feed_dict = {model.in_image: image, model.in_speed: speed}
+    if not getattr(model, 'inference_only', True):
+        # The training graph won't run without its dropout keep_prob.
+        feed_dict[model.keep_prob] = 1.0
+    sess.run(fetches, feed_dict=feed_dict)  # warm up
+    times = []
+    for _ in range(runs):
+        start = time.time()
+        outputs = sess.run(fetches, feed_dict=feed_dict)
+        times.append(time.time() - start)
+    return np.array(times), outputs
+
+
+def bench(checkpoint_path, runs):
+    """Compares the training graph, the inference-only graph and the frozen graph."""
+    path = find_frozen(checkpoint_path)
+    if path is None:
+        print('No up to date frozen graph for %s, run export first.' % checkpoint_path)
+        return
+    print('%-16s %8s %10s %10s %10s %10s' % ('graph', 'nodes', 'load s', 'mean ms', 'p50 ms', 'p99 ms'))
+    results = []
+    for name, load in (('training', lambda: _load_checkpoint(checkpoint_path, False)),
+                       ('inference_only', lambda: _load_checkpoint(checkpoint_path, True)),
+                       ('frozen', lambda: _load_frozen(path))):
+        start = time.time()
+        sess, model = load()
+        load_time = time.time() - start
+        times, outputs = _time_runs(sess, model, runs)
+        nodes = len(sess.graph.as_graph_def().node)
+        sess.close()
+        results.append(outputs)
+        print('%-16s %8d %10.2f %10.2f %10.2f %10.2f' % (
+            name, nodes, load_time, times.mean() * 1000.0, np.percentile(times, 50) * 1000.0,
+            np.percentile(times, 99) * 1000.0))
+    print('max output difference, frozen vs training: %g' % np.abs(np.array(results[0]) - np.array(results[2])).max())
+
+
+if __name__ == '__main__':
+    from docopt import docopt
+    args = docopt(__doc__)
+    checkpoint = args['<checkpoint>'] or config.load('last_tf_model')
+    if not checkpoint:
+        sys.exit('No checkpoint given and no last trained model.')
+    checkpoint = os.path.expanduser(checkpoint)
+    if args['export']:
+        start = time.time()
+        print('Wrote %s in %.1f s' % (export(checkpoint), time.time() - start))
+    bench(checkpoint, int(args['--runs']))
@@ -0,0 +1,312 @@
+"""Runs NNModel's forward pass in numpy, without tensorflow.
+
+The weights are exported from a checkpoint to <checkpoint>_weights.npz
+(model.ckpt -> model_weights.npz). Convolutions are done as im2col plus one
+matrix multiply per layer, into buffers that are allocated once. Loading
+the engine only needs numpy, so the car starts driving much sooner.
+
+The lower precisions simulate what float16, or int8 with a scale per
+output channel, would cost in accuracy. The weights are rounded to that
+precision and stored that way, but expanded back to float32 when loaded,
+since numpy's float16 and integer matrix multiplies are far slower than
+its float32 BLAS ones. So every precision computes in float32 and runs at
+the same speed; only the weight file shrinks. eval shows the accuracy cost.
+
+Usage:
+  numpy_engine.py export [<checkpoint>] [--precision=<p>]
+  numpy_engine.py check [<checkpoint>] [--indir=<path>] [--count=<n>]
+  numpy_engine.py eval [<checkpoint>] [--indir=<path>] [--count=<n>]
+
+Options:
+  --precision=<p>  float32, float16 or int8 [default: float32]
+  --indir=<path>   path to the test npy files [default: ~/training-data]
+  --count=<n>      test frames to compare and time [default: 500]
+
+check runs the test set through the numpy engine and through sess.run on
+the checkpoint, and reports the largest output difference and the
+per-frame latency of each. eval runs the test set at every precision and
+reports the steering and throttle MSE, how far each is from float32, and
+the per-frame latency, which doesn't change with the simulated precision. If no checkpoint is given, the last trained model
+is used.
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import config
+
+# Layer names as NNModel's conv_layer/fc_layer create them, in order.
+CONV_LAYERS = ['conv1', 'conv2', 'conv3', 'conv4']
+FC_LAYERS = ['fc1', 'fc2']  # the speed is appended to fc1's output
+PRECISIONS = ('float32', 'float16', 'int8')
+SCOPES = {'conv1': 'shared_conv', 'conv2': 'shared_conv', 'conv3': 'shared_conv', 'conv4': 'shared_conv',
+          'fc1': 'shared_fc', 'fc2': 'main', 'fc4': 'main'}
+
+
+def weights_path(checkpoint_path, precision='float32'):
+    suffix = '' if precision == 'float32' else '_' + precision
+    return os.path.splitext(checkpoint_path)[0] + '_weights%s.npz' % suffix
+
+
+def find_weights(checkpoint_path, precision='float32'):
+    """Returns the exported weights for checkpoint_path, or None if they
+    haven't been exported or are older than the checkpoint.
+    """
+    path = weights_path(checkpoint_path, precision)
+    if not os.path.exists(path):
+        return None
+    index_path = checkpoint_path + '.index'
+    if os.path.exists(index_path) and os.path.getmtime(index_path) > os.path.getmtime(path):
+        return None
+    return path
+
+
+def export(checkpoint_path, precision='float32'):
+    """Copies the model weights (not the optimizer slots) out of a checkpoint.
+
+    Lower precisions are made from the float32 export, which is written first
+    if it isn't there yet.
+    """
+    out_path = weights_path(checkpoint_path, precision)
+    if precision != 'float32':
+        float_path = find_weights(checkpoint_path) or export(checkpoint_path)
+        np.savez(out_path, **quantize(dict(np.load(float_path)), precision))
+        return out_path
+    import tensorflow as tf
+    reader = tf.train.NewCheckpointReader(checkpoint_path)
+    weights = {}
+    for name in CONV_LAYERS + FC_LAYERS + ['fc4']:
+        for kind in ('W', 'b'):
+            key = '%s_%s' % (kind, name)
+            weights[key] = reader.get_tensor('%s/%s' % (SCOPES[name], key)).astype(np.float32)
+    np.savez(out_path, **weights)
+    return out_path
+
+
+def quantize(weights, precision):
+    """Stores the W_ matrices at precision. Biases stay float32.
+
+    int8 keeps a float32 scale per output channel (the last axis), in
+    W_<layer>_scale, so a channel with small weights doesn't lose them all.
+    """
+    assert precision in PRECISIONS
+    result = {}
+    for key, value in weights.items():
+        if not key.startswith('W_') or precision == 'float32':
+            result[key] = value
+        elif precision == 'float16':
+            result[key] = value.astype(np.float16)
+        else:
+            axes = tuple(range(value.ndim - 1))
+            scale = np.abs(value).max(axis=axes) / 127.0
+            scale[scale == 0] = 1.0
+            result[key] = np.clip(np.round(value / scale), -127, 127).astype(np.int8)
+            result[key + '_scale'] = scale.astype(np.float32)
+    return result
+
+
+def dequantize(weights):
+    """Expands weights saved by quantize() back to float32."""
+    result = {}
+    for key in weights.keys():
+        if key.endswith('_scale'):
+            continue
+        value = weights[key]
+        if key + '_scale' in weights:
+            value = value.astype(np.float32) * weights[key + '_scale']
+        result[key] = np.ascontiguousarray(value, dtype=np.float32)
+    return result
+
+
+class ConvLayer:
+    """5x5 SAME convolution, relu and 2x2 SAME max pool, with its buffers."""
+
+    def __init__(self, W, b, height, width):
+        self.ksize, _, self.channels_in, self.channels_out = W.shape
+        self.height, self.width = height, width
+        self.pad = (self.ksize - 1) // 2
+        # Rows of the patch matrix are (ky, kx, channel), the same order as W.
+        self.W = np.ascontiguousarray(W.reshape(-1, self.channels_out))
+        self.b = b
+        # Zero padded input. Only the middle gets written, so the border stays zero.
+        self.padded = np.zeros((height + 2 * self.pad, width + 2 * self.pad, self.channels_in), dtype=np.float32)
+        self.inner = self.padded[self.pad:self.pad + height, self.pad:self.pad + width]
+        # Every 5x5 patch of the padded input, as a strided view without copying.
+        s = self.padded.strides
+        self.patches = np.lib.stride_tricks.as_strided(
+            self.padded, shape=(height, width, self.ksize, self.ksize, self.channels_in),
+            strides=(s[0], s[1], s[0], s[1], s[2]))
+        self.cols = np.empty((height * width, self.W.shape[0]), dtype=np.float32)
+        self.cols_view = self.cols.reshape(self.patches.shape)
+        self.conv = np.empty((height * width, self.channels_out), dtype=np.float32)
+        # SAME pooling pads odd sizes at the bottom and right. Padding with -inf never wins the max.
+        self.pool_height, self.pool_width = (height + 1) // 2, (width + 1) // 2
+        self.pool_in = np.full((self.pool_height * 2, self.pool_width * 2, self.channels_out), -np.inf, dtype=np.float32)
+        self.pool_in_view = self.pool_in.reshape(self.pool_height, 2, self.pool_width, 2, self.channels_out)
+        self.output = np.empty((self.pool_height, self.pool_width, self.channels_out), dtype=np.float32)
+        self.tmp = np.empty((self.pool_height, 2, self.pool_width, self.channels_out), dtype=np.float32)
+
+    def run(self, x):
+        """x is (height, width, channels_in). Returns the pooled output buffer."""
+        self.inner[...] = x
+        np.copyto(self.cols_view, self.patches)
+        np.dot(self.cols, self.W, out=self.conv)
+        self.conv += self.b
+        np.maximum(self.conv, 0.0, out=self.conv)
+        self.pool_in[:self.height, :self.width] = self.conv.reshape(self.height, self.width, self.channels_out)
+        np.maximum(self.pool_in_view[:, :, :, 0], self.pool_in_view[:, :, :, 1], out=self.tmp)
+        np.maximum(self.tmp[:, 0], self.tmp[:, 1], out=self.output)
+        return self.output
+
+
+class NumpyModel:
+    """NNModel's forward pass on numpy arrays.
+
+    It stands in for both the session and the model on the car: the input and
+    output attributes are just keys, and run() takes fetches and a feed dict
+    like tf.Session.run, so InferenceFeeder works with it unchanged.
+    """
+
+    in_image = 'in_image'
+    in_speed = 'in_speed'
+    steering_regress_result = 'steering_regress_result'
+    throttle_regress_result = 'throttle_regress_result'
+
+    def __init__(self, path):
+        weights = dequantize(np.load(path))
+        self.image_shape = (config.width, config.height, config.img_channels)
+        self.image = np.empty(self.image_shape, dtype=np.float32)
+        self.conv_layers = []
+        height, width = config.width, config.height
+        for name in CONV_LAYERS:
+            layer = ConvLayer(weights['W_' + name], weights['b_' + name], height, width)
+            self.conv_layers.append(layer)
+            height, width = layer.pool_height, layer.pool_width
+        # Flattening NHWC row by row matches tf.reshape in flatten_batch.
+        self.W_fc1, self.b_fc1 = weights['W_fc1'], weights['b_fc1']
+        self.W_fc2, self.b_fc2 = weights['W_fc2'], weights['b_fc2']
+        self.W_fc4, self.b_fc4 = weights['W_fc4'], weights['b_fc4']
+        self.fc1 = np.empty((1, self.W_fc1.shape[1] + 1), dtype=np.float32)  # + speed
+        self.fc1_out = self.fc1[:, :-1]
+        self.fc2 = np.empty((1, self.W_fc2.shape[1]), dtype=np.float32)
+        self.final = np.empty((1, self.W_fc4.shape[1]), dtype=np.float32)
+        self.steering = self.final[:, 0]
+        self.throttle = self.final[:, 1]
+
+    def forward(self, image, speed):
+        """image is one flattened uint8 or float32 image, speed a float.
+        Returns the (1, 2) steering and throttle output buffer.
+        """
+        # Put the image in range [-0.5..0.5] like the graph does.
+        np.multiply(image.reshape(self.image_shape), 1.0 / 255.0, out=self.image, casting='unsafe')
+        self.image -= 0.5
+        act = self.image
+        for layer in self.conv_layers:
+            act = layer.run(act)
+        np.dot(act.reshape(1, -1), self.W_fc1, out=self.fc1_out)
+        self.fc1_out += self.b_fc1
+        np.maximum(self.fc1_out, 0.0, out=self.fc1_out)
+        self.fc1[0, -1] = speed
+        np.dot(self.fc1, self.W_fc2, out=self.fc2)
+        self.fc2 += self.b_fc2
+        np.maximum(self.fc2, 0.0, out=self.fc2)
+        np.dot(self.fc2, self.W_fc4, out=self.final)
+        self.final += self.b_fc4
+        return self.final
+
+    def run(self, fetches, feed_dict):
+        """Like sess.run for a batch of one image with the output names as fetches."""
+        self.forward(feed_dict[self.in_image][0], feed_dict[self.in_speed][0])
+        outputs = {self.steering_regress_result: self.steering, self.throttle_regress_result: self.throttle}
+        return [outputs[fetch] for fetch in fetches]
+
+
+def check(checkpoint_path, indir, count):
+    """Compares the engine with sess.run on the test set, and times both."""
+    import frozen_model
+    path = find_weights(checkpoint_path) or export(checkpoint_path)
+    indir = os.path.expanduser(indir)
+    pics = np.load(os.path.join(indir, 'test_pic_array.npy'), mmap_mode='r')[:count]
+    vels = np.load(os.path.join(indir, 'test_vel_array.npy'))[:count]
+
+    model = NumpyModel(path)
+    sess, net_model = frozen_model._load_checkpoint(checkpoint_path, True)
+    fetches = [net_model.steering_regress_result, net_model.throttle_regress_result]
+    image = np.empty((1, pics.shape[1]), dtype=np.float32)
+    speed = np.empty(1, dtype=np.float32)
+    feed_dict = {net_model.in_image: image, net_model.in_speed: speed}
+    numpy_times, tf_times = [], []
+    max_diff = np.zeros(2)
+    for i in range(len(pics)):
+        image[0] = pics[i]
+        speed[0] = vels[i]
+        start = time.time()
+        ours = model.forward(pics[i], vels[i]).copy()
+        numpy_times.append(time.time() - start)
+        start = time.time()
+        theirs = sess.run(fetches, feed_dict=feed_dict)
+        tf_times.append(time.time() - start)
+        max_diff = np.maximum(max_diff, np.abs(ours[0] - np.array(theirs)[:, 0]))
+    sess.close()
+
+    print('%d test frames' % len(pics))
+    print('max difference: steering %g, throttle %g' % tuple(max_diff))
+    for name, times in (('numpy', numpy_times), ('tensorflow', tf_times)):
+        times = np.array(times[1:]) * 1000.0  # the first call warms up
+        print('%-12s mean %6.2f ms  p50 %6.2f ms  p99 %6.2f ms' % (
+            name, times.mean(), np.percentile(times, 50), np.percentile(times, 99)))
+    return max_diff.max() < 1e-3
+
+
+def evaluate(checkpoint_path, indir, count):
+    """Runs the test set with the weights rounded to each precision and compares them."""
+    indir = os.path.expanduser(indir)
+    pics = np.load(os.path.join(indir, 'test_pic_array.npy'), mmap_mode='r')[:count]
+    vels = np.load(os.path.join(indir, 'test_vel_array.npy'))[:count]
+    # Labels are centered on 0 like the outputs, as in TrainingData.
+    labels = np.stack([np.load(os.path.join(indir, 'test_steer_array.npy'))[:count],
+                       np.load(os.path.join(indir, 'test_throttle_array.npy'))[:count]], axis=1) - 90.0
+
+    print('%d test frames' % len(pics))
+    print('%-8s %9s %12s %12s %12s %12s %9s %9s' % (
+        'weights', 'size KB', 'steer MSE', 'throt MSE', 'steer diff', 'throt diff', 'mean ms', 'p99 ms'))
+    reference = None
+    for precision in PRECISIONS:
+        path = find_weights(checkpoint_path, precision) or export(checkpoint_path, precision)
+        model = NumpyModel(path)
+        outputs = np.empty((len(pics), 2))
+        times = []
+        for i in range(len(pics)):
+            start = time.time()
+            outputs[i] = model.forward(pics[i], vels[i])[0]
+            times.append(time.time() - start)
+        times = np.array(times[1:]) * 1000.0  # the first call warms up
+        if reference is None:
+            reference = outputs
+        mse = ((outputs - labels) ** 2).mean(axis=0)
+        diff = ((outputs - reference) ** 2).mean(axis=0)
+        print('%-8s %9d %12.4f %12.4f %12.6f %12.6f %9.2f %9.2f' % (
+            precision, os.path.getsize(path) // 1024, mse[0], mse[1], diff[0], diff[1],
+            times.mean(), np.percentile(times, 99)))
+    print('diff is the MSE between each precision\'s outputs and float32\'s.')
+    print('All of them compute in float32: the lower precisions only round the weights.')
+
+
+if __name__ == '__main__':
+    from docopt import docopt
+    args = docopt(__doc__)
+    checkpoint = args['<checkpoint>'] or config.load('last_tf_model')
+    if not checkpoint:
+        sys.exit('No checkpoint given and no last trained model.')
+    checkpoint = os.path.expanduser(checkpoint)
+    if args['export']:
+        assert args['--precision'] in PRECISIONS, 'Unknown precision: %s' % args['--precision']
+        print('Wrote %s' % export(checkpoint, args['--precision']))
+    elif args['check']:
+        sys.exit(0 if check(checkpoint, args['--indir'], int(args['--count'])) else 1)
+    elif args['eval']:
+        evaluate(checkpoint, args['--indir'], int(args['--count']))
@@ -0,0 +1,116 @@
+"""Sends steering and throttle to the output Arduino at a fixed rate.
+
+The control loop only calls update() with its latest command. The actuator
+repeats that command with a keepalive on its own thread at rate_hz, so the
+Arduino hears from us on time no matter how long inference or a disk write
+takes. If no new command shows up for max_age seconds, it stops the car.
+Stopping the actuator leaves the car at neutral throttle and centred steering.
+"""
+
+import threading
+
+import scheduler
+from scheduler import monotonic
+
+
+class Actuator(object):
+  def __init__(self, serial_link, send_func, stop_func, rate_hz=100.0, max_age=0.25):
+    """send_func(old_steering, old_throttle, steering, throttle, serial_link)
+    sends one command, like main_car.process_output. stop_func(steering,
+    throttle, serial_link) sends the stop sequence, like main_car.stop_car.
+    """
+    self.serial_link = serial_link
+    self.send_func = send_func
+    self.stop_func = stop_func
+    self.max_age = max_age
+    self.lock = threading.Lock()
+    # Latest command and when it arrived. Nothing is sent before the first one.
+    self.steering = 90
+    self.throttle = 90
+    self.command_time = None
+    # tracing.FrameTrace of the frame the command came from, marked when it's first sent.
+    self.trace = None
+    # Set by brake(), cleared by the next update().
+    self.braking = False
+    self.car_stopped = False
+    # Held while a tick sends, so stop() can send the last command after it.
+    self.send_lock = threading.Lock()
+    self.started = False
+    self.stopping = False
+    # Counters.
+    self.updates = 0
+    self.timeouts = 0  # times the car was stopped because the command got too old
+    self.max_command_age = 0.0  # oldest command repeated before a stop
+    self.scheduler = scheduler.TickScheduler()
+    self.task = self.scheduler.add(self.tick, rate_hz)
+
+  def start(self):
+    self.started = True
+    self.scheduler.start()
+    return self
+
+  def update(self, steering, throttle, trace=None):
+    """Sets the command to repeat from now on."""
+    with self.lock:
+      self.steering = steering
+      self.throttle = throttle
+      self.command_time = monotonic()
+      self.trace = trace
+      self.braking = False
+      self.updates += 1
+
+  def brake(self):
+    """Sends the stop sequence once and holds the car stopped until the next update()."""
+    with self.lock:
+      if self.command_time is None:
+        self.command_time = monotonic()
+      self.braking = True
+
+  def tick(self):
+    # Runs on the scheduler thread.
+    with self.send_lock:
+      if not self.stopping:
+        self._send_command()
+
+  def _send_command(self):
+    now = monotonic()
+    with self.lock:
+      if self.command_time is None:
+        return
+      steering, throttle = self.steering, self.throttle
+      braking = self.braking
+      age = now - self.command_time
+      trace, self.trace = self.trace, None
+    if braking or age > self.max_age:
+      if not self.car_stopped:
+        if not braking:
+          self.timeouts += 1
+          print('Actuator: no command for %.0f ms, stopping the car.' % (age * 1000.0))
+        self.stop_func(steering, throttle, self.serial_link)
+        self.car_stopped = True
+      else:
+        # Keep the link alive without changing the stopped outputs.
+        self.send_func(90, 0, 90, 0, self.serial_link)
+      return
+    self.car_stopped = False
+    self.max_command_age = max(self.max_command_age, age)
+    # Repeat the whole command every tick, so a garbled line is fixed on the next one.
+    self.send_func(-1, -1, steering, throttle, self.serial_link)
+    if trace is not None:
+      trace.mark('write')
+
+  def stop(self, timeout=0.5):
+    """Sends neutral throttle and centred steering once, waits up to timeout
+    seconds for it to be written, then stops sending.
+    """
+    with self.send_lock:
+      self.stopping = True
+    if self.started:
+      self.send_func(-1, -1, 90, 90, self.serial_link)
+      if not self.serial_link.flush(timeout):
+        print('Actuator: the last command was not written within %.0f ms.' % (timeout * 1000.0))
+    self.scheduler.stop()
+
+  def report(self):
+    return '%-8s %d updates, %d timeouts, max command age %.1f ms  %s' % (
+      'actuator', self.updates, self.timeouts, self.max_command_age * 1000.0, self.task)
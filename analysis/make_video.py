@@ -16,6 +16,9 @@ import envoy
 from PIL import Image
 from PIL import ImageDraw
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import recording_index
+
 
 # Read args.
 args = docopt(__doc__)
@@ -35,21 +38,19 @@ if not os.path.exists(out_path):
 
 # Write telemetry on each image.
 inpath = os.path.expanduser(args['<inpath>'])
-file_count = len([f for f in os.listdir(inpath) if 'lidar' not in f])
+index = recording_index.load(inpath)
+file_count = len(index)
 green = (41, 153, 82)
 red = (179, 46, 46)
 i = 0
-for filename in os.listdir(inpath):
-  if 'frame' not in filename:
-    continue
-  if 'lidar' in filename:
-    continue
+for row in index:
+  filename = os.path.basename(row['path'])
   # Get telemetry.
-  steering = int(float(filename.split('_')[5]))
-  throttle = int(float(filename.split('_')[3]))
-  odometer = filename.split('_')[9].split('.')[0]
+  steering = int(row['ste'])
+  throttle = int(row['thr'])
+  odometer = str(row['odo'])
   # Draw on the image.
-  image = Image.open(os.path.join(inpath, filename))
+  image = Image.open(row['path'])
   drawing = ImageDraw.Draw(image)
   drawing.rectangle([(0, 90), (30, 120)], (255, 255, 255))
   drawing.text((0, 90), 's %s' % steering, green)
@@ -12,10 +12,14 @@ Options:
 
 import os
 import pprint
+import sys
 
 from docopt import docopt
 import matplotlib.pyplot as plt
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import recording_index
+
 
 # Get args.
 args = docopt(__doc__)
@@ -27,47 +31,25 @@ out_path = os.path.join(args['--outdir'], '%s-analysis' % in_path_last_dir)
 if not os.path.exists(out_path):
   os.makedirs(out_path)
 
-# Get all filenames in specified dir and build outdir.
-filenames = os.listdir(in_path)
-
-# Parse all filenames (ala frame_02955_thr_99_ste_79_mil_100300_odo_2354.png).
-parsed_data = []
-for filename in filenames:
-  if 'lidar' in filename:
-    continue
-  if 'frame' not in filename:
-    continue
-  if 'lidar' in filename:
-    continue
-  split_filename = filename.split('_')
-  data = {
-    'filename': filename,
-    'frame': split_filename[1],
-    'throttle': split_filename[3],
-    'steering': split_filename[5],
-    'millis': split_filename[7],
-    'odometer': split_filename[9].split('.')[0],
-  }
-  parsed_data.append(data)
-
-# sort by frame otherwise the graph will be all over the place.
-parsed_data = sorted(parsed_data, key=lambda x: x['frame'])
-# parsed_data = parsed_data[:1500]
-print len(parsed_data)
+# Parsed filenames (ala frame_02955_thr_99_ste_79_mil_100300_odo_2354.png), sorted
+# by frame otherwise the graph will be all over the place.
+index = recording_index.load(in_path)
+# index = index[:1500]
+print len(index)
 
 # Setup x-values (time in seconds).
-x_values = [int(d['millis']) / 1000. for d in parsed_data]
-#pprint.pprint([d for d in parsed_data])
+x_values = index['mil'] / 1000.
+#pprint.pprint(index)
 
 # Plot each parameter.
 labels = [
-  ('steering', 'blue'),
-  ('throttle', 'red'),
-  ('odometer', 'green'),
-  ('frame', 'purple'),
+  ('steering', 'blue', 'ste'),
+  ('throttle', 'red', 'thr'),
+  ('odometer', 'green', 'odo'),
+  ('frame', 'purple', 'frame'),
 ]
-for param, color in labels:
-  y_values = [d[param] for d in parsed_data]
+for param, color, field in labels:
+  y_values = index[field]
   figure, axes = plt.subplots(nrows=1, ncols=1, figsize=(20, 8))
   axes.plot(x_values, y_values, marker='.', color=color)
   plt.xlabel('time (s)')
@@ -3,11 +3,35 @@
 Largely from pyimagesearch.com
 """
 
+import os
+import sys
 import threading
+import time
+
 import cv2
+import numpy as np
+
+import config
+import session_file
+from scheduler import monotonic
+
+# Python 2 implements timed condition waits by polling with sleeps of up to
+# 50 ms, so there we wait untimed and check the deadline on every wakeup.
+# The capture thread wakes waiters after every read attempt.
+TIMED_WAIT = sys.version_info[0] >= 3
+
+# Smoothing factor for the frame interval and jitter averages.
+INTERVAL_ALPHA = 0.05
 
 class CameraStream(object):
-  def __init__(self, src=0):
+  def __init__(self, src=0, ring_size=4):
+    """Frames are captured into a ring of ring_size preallocated buffers.
+
+    read() hands out the newest buffer without copying it. It stays valid
+    until the capture thread comes back around to it, ring_size - 1 frames
+    later, so hang on to it longer than that only after copying it.
+    """
+    assert ring_size >= 2
     self.stream = cv2.VideoCapture(src)
     if not self.stream.isOpened():
       src = 1 - src
@@ -16,11 +40,30 @@ class CameraStream(object):
         sys.exit("Error: Camera didn't open for capture.")
 
     # Setup frame dims.
-    self.stream.set(cv2.CAP_PROP_FRAME_WIDTH, 320)
-    self.stream.set(cv2.CAP_PROP_FRAME_HEIGHT, 240)
+    self.stream.set(cv2.CAP_PROP_FRAME_WIDTH, config.camera_width)
+    self.stream.set(cv2.CAP_PROP_FRAME_HEIGHT, config.camera_height)
+
+    self.grabbed, frame = self.stream.read()
+    if not self.grabbed:
+      sys.exit("Error: Camera didn't return a frame.")
+    self._setup_ring(frame, ring_size)
 
-    self.grabbed, self.frame = self.stream.read()
+  def _setup_ring(self, frame, ring_size):
+    self.ring = [np.empty_like(frame) for _ in range(ring_size)]
+    self.ring_seq = [0] * ring_size
+    self.ring_time = [0.0] * ring_size
+    # Guards the ring bookkeeping and signals new frames to wait_next().
+    self.cond = threading.Condition()
+    # The first frame goes in slot 0 as sequence number 1.
+    self.ring[0][...] = frame
+    self.ring_seq[0] = 1
+    self.ring_time[0] = monotonic()
+    self.seq = 1
+    self.latest = 0
     self.stopped = False
+    # Measured frame interval and jitter (mean deviation from the interval), in seconds.
+    self.interval = 0.0
+    self.jitter = 0.0
 
   def start(self):
     """Start the thread to read frames from the video stream."""
@@ -32,33 +75,158 @@ class CameraStream(object):
   def update(self):
     """Grab frames until told to stop."""
     while not self.stopped:
-      self.grabbed, self.frame = self.stream.read()
+      slot, buf = self._next_slot()
+      self.grabbed, frame = self.stream.read(buf)
+      capture_time = monotonic()
+      if not self.grabbed:
+        with self.cond:
+          self.cond.notify_all()
+        continue
+      if frame is not buf:
+        # cv2 allocated a new image (the size changed?), copy it into the ring.
+        buf[...] = frame
+      self._publish(slot, capture_time)
+
+  def _next_slot(self):
+    """Returns the slot (and its buffer) the next frame goes in."""
+    slot = (self.latest + 1) % len(self.ring)
+    # Mark the slot as being overwritten before anything writes into it.
+    with self.cond:
+      self.ring_seq[slot] = 0
+    return slot, self.ring[slot]
+
+  def _publish(self, slot, capture_time):
+    """Makes the frame in slot the newest one and wakes up wait_next()."""
+    with self.cond:
+      self._update_timing(capture_time - self.ring_time[self.latest])
+      self.seq += 1
+      self.ring_seq[slot] = self.seq
+      self.ring_time[slot] = capture_time
+      self.latest = slot
+      self.cond.notify_all()
+
+  def _update_timing(self, interval):
+    if self.interval == 0.0:
+      self.interval = interval
+      return
+    self.jitter += INTERVAL_ALPHA * (abs(interval - self.interval) - self.jitter)
+    self.interval += INTERVAL_ALPHA * (interval - self.interval)
 
   def read(self):
-    return self.frame
+    """Returns (frame, seq, capture_time) for the newest frame, without copying.
+
+    seq goes up by one for every captured frame, so a caller can tell when
+    it's seen a frame before. capture_time is on the scheduler.monotonic clock.
+    """
+    with self.cond:
+      slot = self.latest
+      return self.ring[slot], self.ring_seq[slot], self.ring_time[slot]
+
+  def wait_next(self, last_seq=None, timeout=None):
+    """Blocks until there's a frame newer than last_seq and returns it like read().
+
+    last_seq defaults to the newest frame at the time of the call. Returns
+    None if no new frame arrived within timeout seconds.
+    """
+    deadline = None if timeout is None else monotonic() + timeout
+    with self.cond:
+      if last_seq is None:
+        last_seq = self.seq
+      while self.seq <= last_seq:
+        if deadline is None:
+          self.cond.wait()
+          continue
+        remaining = deadline - monotonic()
+        if remaining <= 0:
+          return None
+        self.cond.wait(remaining if TIMED_WAIT else None)
+      slot = self.latest
+      return self.ring[slot], self.ring_seq[slot], self.ring_time[slot]
+
+  def fps(self):
+    """Measured camera frame rate."""
+    return 1.0 / self.interval if self.interval > 0 else 0.0
+
+  def is_current(self, frame, seq):
+    """True if frame (from read()) still holds frame seq and hasn't been reused."""
+    with self.cond:
+      for slot in range(len(self.ring)):
+        if self.ring[slot] is frame:
+          return self.ring_seq[slot] == seq
+    return False
 
   def stop(self):
     self.stopped = True
 
-'''
-import glob,os,sys
-# Replays a recorded lap
-class VirtualCameraStream(object):
-  def __init__(self, src=0):
-    self.stopped = False
-    self.files = glob.glob(os.getenv('IMAGES_DIR')+'/*.png')
-    self.index = 0
 
-  def start(self):
+class ReplayCameraStream(CameraStream):
+  def __init__(self, path, speed=1.0, loop=True, fps=30.0, ring_size=4):
+    """Replays a recorded png folder or session in place of the camera.
+
+    Frames come out with the recorded timing (fps for png folders, which
+    don't store it) sped up by speed. A speed of 0 replays as fast as the
+    frames can be loaded. Without loop, the stream stops after the last frame.
+    Everything else works like CameraStream.
+    """
+    assert ring_size >= 2
+    self.path = path
+    self.speed = speed
+    self.loop = loop
+    if session_file.is_session(path):
+      self.session = session_file.SessionReader(path)
+      self.files = None
+      count = len(self.session)
+      # Recorded capture times, relative to the first frame. Imported sessions
+      # only have file times, which aren't a capture rate.
+      times = self.session.telemetry['timestamp'].astype(np.float64)
+      if count > 1 and np.median(np.diff(times)) > 0.001:
+        self.times = times - times[0]
+      else:
+        self.times = np.arange(count) / fps
+    else:
+      self.session = None
+      frames = []
+      for filename in os.listdir(path):
+        parsed = session_file.parse_frame_filename(filename)
+        if parsed is not None:
+          frames.append((parsed['frame'], filename))
+      frames.sort()
+      self.files = [os.path.join(path, filename) for _, filename in frames]
+      count = len(self.files)
+      self.times = np.arange(count) / fps
+    if count == 0:
+      sys.exit("Error: No frames to replay in %s" % path)
     self.index = 0
-    return self
+    self.frames_played = 0
+    self.grabbed = True
+    self._setup_ring(self._load(0), ring_size)
 
-  def read(self):
-    img = cv2.imread(self.files[self.index])
-    self.index += 1
-    self.index = self.index % len(self.files)
-    return img
+  def _load(self, index):
+    if self.session is not None:
+      return self.session.frame(index)
+    frame = cv2.imread(self.files[index])
+    if frame is None:
+      sys.exit("Error: Couldn't read %s" % self.files[index])
+    return frame
 
-  def stop(self):
+  def update(self):
+    """Replay frames on the recorded schedule until told to stop."""
+    start = monotonic()
+    while not self.stopped:
+      self.index += 1
+      if self.index >= len(self.times):
+        if not self.loop:
+          break
+        self.index = 0
+        start = monotonic()
+      if self.speed > 0:
+        delay = start + self.times[self.index] / self.speed - monotonic()
+        if delay > 0:
+          time.sleep(delay)
+      slot, buf = self._next_slot()
+      buf[...] = self._load(self.index)
+      self._publish(slot, monotonic())
+      self.frames_played += 1
     self.stopped = True
-'''
+    with self.cond:
+      self.cond.notify_all()
@@ -12,10 +12,74 @@ running_on_laptop = True
 should_use_gpu = 0
 
 camera_id = 0
+# Frame size asked of the camera. Shadow models are set up for frames this size
+# before the camera is opened.
+camera_width = 320
+camera_height = 240
+
+# What paces the main_car.py control loop. 'camera' runs a tick as soon as the
+# camera delivers a new frame (giving up after frame_timeout_secs). 'timer' runs
+# ticks at loop_rate_hz; loop_overrun_policy says what to do when a tick runs
+# long: 'skip' drops the missed ticks, 'catch_up' runs a few of them back to back.
+frame_sync = 'camera'
+frame_timeout_secs = 0.5
+loop_rate_hz = 30.0
+loop_overrun_policy = 'skip'
+# Recording: writer threads, frames allowed to wait for the disk, and what to do
+# when the disk falls behind: 'block', 'drop_oldest' or 'drop_newest'. 'block' is
+# refused in tf mode, where waiting on the disk would hold up driving.
+record_workers = 2
+record_queue_size = 30
+record_drop_policy = 'drop_oldest'
+# 'png' writes one frame_..._thr_..._ste_..._mil_....png per frame. 'session' appends
+# frames and telemetry to a session file (see session_file.py), compressed with
+# session_compression: 'none' or 'zlib'.
+record_format = 'png'
+session_compression = 'none'
+# How often (in seconds) main_car.py prints throughput and queue depth for each pipeline stage.
+pipeline_report_secs = 10.0
+# The actuator repeats the latest steering and throttle to the output Arduino
+# actuator_rate_hz times a second, and stops the car if there's been no new
+# command for actuator_max_age_secs.
+actuator_rate_hz = 100.0
+actuator_max_age_secs = 0.25
+
 # Uncomment the following line to specify the path of the trained mdodel, or put the uncommented line in local_config.py.
 # If no tf_checkpoint_file variable is found, the latest generated model is loaded.
 #tf_checkpoint_file = "/Users/otaviogood/convnet02-results/2016_11_06__04_48_13_PM/model.ckpt" 
 
+# What runs the model on the car: 'tensorflow', or 'numpy' for NeuralNet/numpy_engine.py,
+# which needs no tensorflow session and starts much faster. Only for the alexnet model.
+inference_engine = 'tensorflow'
+# Accuracy simulation for the numpy engine only: 'float16' or 'int8' rounds its weights
+# to that precision (int8 with a scale per channel) to see what it would cost in driving.
+# The math stays float32, so it's no faster. Anything but 'float32' is refused in
+# tensorflow mode. Compare them with: python NeuralNet/numpy_engine.py eval
+simulated_weight_precision = 'float32'
+# Before driving, tf mode runs warmup_frames synthetic frames through the model and
+# won't arm if the p99 latency is over frame_budget_ms (one frame at 30 fps).
+warmup_frames = 50
+frame_budget_ms = 33.0
+# Tensorflow thread pools for the car's session (0 lets tensorflow pick) and the
+# cores its threads may run on (None for all of them). Tune them with tune_threads.py,
+# which writes the best ones to local_config.py.
+tf_intra_op_threads = 0
+tf_inter_op_threads = 0
+tf_cpu_affinity = None
+# In tf mode, check for a new checkpoint every model_watch_secs (0 to never), and
+# switch to it while driving once it's model_watch_settle_secs old and warmed up.
+model_watch_secs = 2.0
+model_watch_settle_secs = 5.0
+# Checkpoints to run alongside the driving model in tf mode, for comparing them on the
+# track. They don't drive. Their predictions and latencies are logged to <session>_shadow.csv.
+# They run in a separate process at nice shadow_nice, on shadow_cpu_affinity (None for
+# any core), and only take frames when they've finished the last one. The affinity needs
+# os.sched_setaffinity (Python 3 on Linux); elsewhere it's ignored with a warning.
+shadow_checkpoints = []
+shadow_nice = 10
+shadow_cpu_affinity = None
+shadow_intra_op_threads = 1
+
 # Either alexnet or lstm. Use lower case.
 neural_net_mode = 'alexnet'
 
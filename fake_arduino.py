@@ -0,0 +1,112 @@
+"""A pty-backed stand-in for the output Arduino.
+
+Opens a pseudo terminal and behaves like arduino/output_3volt on the other
+end: takes "S<steering>" and "D<throttle>" commands (anything else, like
+"keepalive", is ignored the same way the firmware ignores it), reports
+odometer ticks as "Mil\\t<millis>" and the switch as "Button\\t<state>".
+Open port_name with pyserial like a real Arduino.
+"""
+
+import os
+import select
+import threading
+import time
+import tty
+
+from scheduler import monotonic
+
+
+class FakeArduino(object):
+  def __init__(self, odo_ticks_per_sec=20.0):
+    """odo_ticks_per_sec is the rate of Mil lines while the throttle is above neutral."""
+    self.master, self.slave = os.openpty()
+    tty.setraw(self.slave)
+    self.port_name = os.ttyname(self.slave)
+    self.odo_ticks_per_sec = odo_ticks_per_sec
+    self.start_time = monotonic()
+    self.buffer = b''
+    self.lock = threading.Lock()
+    # Last commanded servo values, like the firmware's steeringValue and driveValue.
+    self.steering = 90
+    self.throttle = 90
+    self.button = 0
+    # Counters.
+    self.steering_commands = 0
+    self.throttle_commands = 0
+    self.keepalives = 0
+    self.unknown_commands = 0
+    self.last_command_time = 0.0
+    self.stopped = False
+
+  def start(self):
+    self._send(b'CarRace IOHub Setup BEGIN\r\nCarRace IOHub Setup END\r\n')
+    self._send(b'Button\t%d\r\n' % self.button)
+    t = threading.Thread(target=self.update, args=())
+    t.daemon = True
+    t.start()
+    return self
+
+  def millis(self):
+    return int((monotonic() - self.start_time) * 1000)
+
+  def update(self):
+    next_tick = monotonic()
+    while not self.stopped:
+      try:
+        readable, _, _ = select.select([self.master], [], [], 0.005)
+        data = os.read(self.master, 4096) if readable else b''
+      except (OSError, ValueError, select.error):
+        # The pty was closed by stop().
+        break
+      if data:
+        self._handle_input(data)
+      now = monotonic()
+      if self.throttle > 90 and now >= next_tick:
+        next_tick = now + 1.0 / self.odo_ticks_per_sec
+        self._send(b'Mil\t%d\r\n' % self.millis())
+
+  def _handle_input(self, data):
+    self.buffer += data
+    while b'\n' in self.buffer:
+      line, self.buffer = self.buffer.split(b'\n', 1)
+      with self.lock:
+        self.last_command_time = monotonic()
+        code, value = line[:1], line[1:]
+        if code == b'S':
+          self.steering = max(0, min(180, _to_int(value)))
+          self.steering_commands += 1
+        elif code == b'D':
+          self.throttle = max(0, min(180, _to_int(value)))
+          self.throttle_commands += 1
+        elif line == b'keepalive':
+          self.keepalives += 1
+        else:
+          self.unknown_commands += 1
+
+  def set_button(self, state):
+    """Flips the start switch, which the firmware reports right away."""
+    self.button = state
+    self._send(b'Button\t%d\r\n' % state)
+
+  def _send(self, data):
+    os.write(self.master, data)
+
+  def stop(self):
+    self.stopped = True
+    time.sleep(0.01)
+    os.close(self.master)
+    os.close(self.slave)
+
+
+def _to_int(value):
+  """Like Arduino's String.toInt(): leading digits, 0 if there are none."""
+  digits = b''
+  for i in range(len(value)):
+    c = value[i:i + 1]
+    if not (c.isdigit() or (i == 0 and c == b'-')):
+      break
+    digits += c
+  try:
+    return int(digits)
+  except ValueError:
+    return 0
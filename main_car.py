@@ -1,25 +1,40 @@
 """Records training data and / or drives the car with tensorflow.
 
 Usage:
-        main_car.py record
-        main_car.py tf
+        main_car.py record [--replay=<path>] [--speed=<x>] [--fake-arduino] [--profile-startup]
+        main_car.py tf [--replay=<path>] [--speed=<x>] [--fake-arduino] [--profile-startup]
+
+Options:
+        --replay=<path>  Replay a recorded png folder or session instead of using the camera.
+        --speed=<x>      Replay speed. 1 is real time, 0 is as fast as frames load [default: 1]
+        --fake-arduino   Talk to an emulated output Arduino on a pty instead of the real one.
+        --profile-startup  Print how long each import and setup step took before driving.
+
+Examples:
+        python main_car.py tf --replay=~/training-images/2017_10_01__01_02_03_PM --speed=2 --fake-arduino
 """
 
+import time
+# For --profile-startup. Heavy modules (cv2, tensorflow, the NeuralNet code) are
+# imported where they're first needed, so record mode never loads tensorflow.
+import_start_time = time.time()
+
 import math
 import os
-import re
 import sys
-import time
 import subprocess
 import errno
 
-import cv2
 from docopt import docopt
-import serial
-import tensorflow as tf
 
-import camera
+import actuator
 import key_watcher
+import pipeline
+import recorder
+import scheduler
+import serial_service
+import session_file
+import tracing
 
 # Data logging
 import debug_message
@@ -34,40 +49,24 @@ nn_directory = os.path.join(carputer_directory, "NeuralNet")
 sys.path.append(carputer_directory)
 import config
 
-# Neural Network modules
+# Neural Network modules are imported in setup_tensorflow().
 # sys.path.append(nn_directory)
-from NeuralNet.convnetshared1 import NNModel
-from NeuralNet.data_model import TrainingData
-
-# Get args.
-args = docopt(__doc__)
-
 
-# Check the mode: recording vs TF driving vs TF driving + recording.
-if args['record']:
-        we_are_autonomous = False
-        we_are_recording = True
-        print("\n------ Ready to record training data ------\n")
-elif args['tf']:
-        we_are_autonomous = True
-        we_are_recording = True
-        print("\n****** READY TO DRIVE BY NEURAL NET and record data ******\n")
-
-
-# Set up camera and key watcher.
-camera_stream = camera.CameraStream(src=config.camera_id).start()
+# Args, mode and camera are set up in main().
+args = None
+we_are_autonomous = False
+we_are_recording = False
+camera_stream = None
 last_key = ['']
-key_watcher.KeyWatcher(last_key).start()
 
 
-# Setup buffers and vars used by arduinos.
-buffer_in = ''
-buffer_out = ''
+# Setup vars used by arduinos.
 milliseconds = 0.0
 button_arduino_out = 0
 button_arduino_in = 0
 
 imu_stream = ''
+fake_output_arduino = None
 
 
 def mkdir_p(path):
@@ -88,6 +87,8 @@ def touch(path):
 def setup_serial_and_reset_arduinos():
         # This will set up the serial ports. If they are already set up, it will
         # reset them, which also resets the Arduinos.
+        global fake_output_arduino
+        import serial
         print("Setting up serial and resetting Arduinos.")
         # On MacOS, you can find your Arduino via Terminal with
         # ls /dev/tty.*
@@ -102,6 +103,12 @@ def setup_serial_and_reset_arduinos():
         port_in = None
         # port_in = serial.Serial(name_in, 38400, timeout=0.0)
         # 3 volt Arduino Due, servos for output.
+        if args['--fake-arduino']:
+                # An emulated Arduino on a pty, for running without the car.
+                import fake_arduino
+                fake_output_arduino = fake_arduino.FakeArduino().start()
+                name_out = fake_output_arduino.port_name
+                print("Using a fake output Arduino on %s" % name_out)
         port_out = serial.Serial(name_out, 115200, timeout=0.0)
 
         imu_port = None
@@ -132,106 +139,63 @@ def make_data_folder(base_path):
         return session_full_path
 
 
-def process_input(port_in, port_out):
-        """Reads steering, throttle, aux1 and button data reported from the arduinos.
+def record_dir(session_full_path):
+        # Where a recording's frames end up: the images folder, or the session next to it.
+        if config.record_format == 'session':
+                return session_full_path + '.session'
+        return session_full_path
+
+
+def process_input(serial_link):
+        """Returns the latest steering, throttle, aux1 and button data reported from the arduinos.
 
         Returns: (steering: int, throttle: int, aux1: int, button_arduino_in: int, button_arduino_out: int)
 
-        Return values may be None if the data from the arduino isn't related to the
-        steering or throttle.
+        Steering, throttle and aux1 are None until the input arduino has reported them.
         """
-        # Input is buffered because sometimes partial lines are read
-        global button_arduino_in, button_arduino_out, buffer_in, buffer_out, milliseconds
-        try:
-                buffer_in += port_in.read(port_in.in_waiting).decode('ascii')
-                buffer_out += port_out.read(port_out.in_waiting).decode('ascii')
-        except UnicodeDecodeError:
-                # We can rarely get bad data over the serial port. The error looks like this:
-                # buffer_in += port_in.read(port_in.in_waiting).decode('ascii')
-                # UnicodeDecodeError: 'ascii' codec can't decode byte 0xf0 in position 0: ordinal not in range(128)
-                buffer_in = ''
-                buffer_out = ''
-                print("Mysterious serial port error. Let's pretend it didn't happen. :)")
-        # Init steering, throttle and aux1.
-        steering, throttle, aux1 = None, None, None
-        # Read lines from input Arduino
-        while '\n' in buffer_in:
-                line, buffer_in = buffer_in.split('\n', 1)
-                match = re.search(r'(\d+) (\d+) (\d+)', line)
-                if match:
-                        steering = int(match.group(1))
-                        throttle = int(match.group(2))
-                        aux1 = int(match.group(3))
-                if line[0:1] == 'S':
-                        # This is just a toggle button
-                        button_arduino_in = 1 - button_arduino_in
-                        print "ButtonAIn toggle"
-        # Read lines from output Arduino
-        while '\n' in buffer_out:
-                line, buffer_out = buffer_out.split('\n', 1)
-                if line[0:3] == 'Mil':
-                        sp = line.split('\t')
-                        milliseconds = int(sp[1])
-                if line[0:3] == 'IMU':
-                        pass
-                                                # quat.xyzw, gyro.xyz, acc.xyz
-                                                # IMU -0.0233 -0.0109 -0.0178 0.9995 0.0000 0.0000 0.0000 0.0400 -0.0400 0.1900
-                                                # sp = line.split(' ')
-                                                # try:
-                                                #     quat = [float(sp[1]), float(sp[2]), float(sp[3]), float(sp[4])]
-                                                # except:
-                                                #     quat = [0.0, 0.0, 0.0, 0.0]
-                                                # try:
-                                                #     gyro = [float(sp[5]), float(sp[6]), float(sp[7])]
-                                                # except:
-                                                #     gyro = [0.0, 0.0, 0.0]
-                                                # try:
-                                                #     accel = [float(sp[8]), float(sp[9]), float(sp[10])]
-                                                # except:
-                                                #     accel = [0.0, 0.0, 0.0]
-
-                                                # telemetry = quat + gyro + accel
-                if line[0:6] == 'Button':
-                        sp = line.split('\t')
-                        button_arduino_out = int(sp[1])
+        # The serial service reads and parses the ports on its own thread as
+        # bytes arrive, so this only picks up the latest values.
+        global button_arduino_in, button_arduino_out, milliseconds
+        steering, throttle, aux1, button_arduino_in, button_arduino_out, milliseconds = serial_link.read_state()
         return steering, throttle, aux1, button_arduino_in, button_arduino_out
 
 
-def process_output(old_steering, old_throttle, steering, throttle, port_out):
+def process_output(old_steering, old_throttle, steering, throttle, serial_link):
         # Adjust the steering and throttle.
         throttle = 90 if 88 <= throttle <= 92 else min(throttle, 130)
+        commands = []
         # Update steering
         if old_steering != steering:
-                port_out.write(('S%d\n' % steering).encode('ascii'))
+                commands.append('S%d\n' % steering)
         # Update throttle
         if old_throttle != throttle:
-                port_out.write(('D%d\n' % throttle).encode('ascii'))
+                commands.append('D%d\n' % throttle)
         # Send keepalive.
-        port_out.write(('keepalive\n').encode('ascii'))
-        # Write all.
-        port_out.flush()
+        commands.append('keepalive\n')
+        # The serial service writes all of it in one go.
+        serial_link.send(''.join(commands).encode('ascii'))
 
 
-def stop_car(steering, throttle, port_out):
+def stop_car(steering, throttle, serial_link):
 
         # Send 90
-        process_output(-1, -1, 90, 0, port_out)
+        process_output(-1, -1, 90, 0, serial_link)
         time.sleep(0.016)
 
         # Send 0 # Full brake
-        process_output(-1, -1, 90, 90, port_out)
+        process_output(-1, -1, 90, 90, serial_link)
         time.sleep(0.016)
 
         # Send 90 to reset esc
-        process_output(-1, -1, 90, 0, port_out)
+        process_output(-1, -1, 90, 0, serial_link)
         time.sleep(0.016)
 
 
-def center_esc(port_out):
+def center_esc(serial_link):
         # 90 Throttle centers the esc
-        process_output(-1, -1, 90, 90, port_out)
+        process_output(-1, -1, 90, 90, serial_link)
 
-        #process_output(-1, -1, steering, throttle, port_out)
+        #process_output(-1, -1, steering, throttle, serial_link)
 
 
 def invert_log_bucket(a):
@@ -254,26 +218,79 @@ def invert_log_bucket(a):
 ##########################
 # Tensorflow Functions   #
 ##########################
-def setup_tensorflow():
-                """Restores a tensorflow session and returns it if successful
+def find_checkpoint():
+                """The checkpoint to drive with: config.tf_checkpoint_file if it's set,
+                otherwise the last model training saved.
                 """
-                net_model = NNModel()
+                try:
+                                return config.tf_checkpoint_file
+                except AttributeError:
+                                return config.load('last_tf_model') #gets the cached last tf trained model
 
-                tf_config = tf.ConfigProto(device_count = {'GPU':config.should_use_gpu})
-                sess = tf.Session(config=tf_config)
 
-                # Add ops to save and restore all of the variables
-                saver = tf.train.Saver()
+def setup_tensorflow(profile=None):
+                """Restores a tensorflow session and returns it if successful
+                """
+                if config.inference_engine != 'numpy' and config.simulated_weight_precision != 'float32':
+                                sys.exit("simulated_weight_precision is '%s', but only the numpy engine can simulate it." %
+                                         config.simulated_weight_precision)
 
                 # Load the model checkpoint file
-                try:
-                                tmp_file = config.tf_checkpoint_file
+                tmp_file = find_checkpoint()
+                if getattr(config, 'tf_checkpoint_file', None):
                                 print("Loading model from config: {}".format(tmp_file))
-                except:
-                        tmp_file = config.load('last_tf_model') #gets the cached last tf trained model
+                else:
                         print "loading latest trained model: " + str(tmp_file)
                                 # print("CAN'T FIND THE GOOD MODEL")
                                 # sys.exit(-1)
+                return load_model(tmp_file, profile)
+
+
+def load_model(tmp_file, profile=None):
+                """Returns (sess, net_model) for checkpoint tmp_file, each model in a graph
+                of its own so a new one can be loaded while another is driving.
+                """
+                if config.inference_engine == 'numpy':
+                                from NeuralNet import numpy_engine
+                                weights_file = (numpy_engine.find_weights(tmp_file, config.simulated_weight_precision) or
+                                                numpy_engine.export(tmp_file, config.simulated_weight_precision))
+                                print("Using the numpy engine with weights: {}".format(weights_file))
+                                # The numpy model is its own session.
+                                net_model = numpy_engine.NumpyModel(weights_file)
+                                if profile is not None:
+                                                profile.mark('load numpy model')
+                                return net_model, net_model
+
+                import tensorflow as tf
+                from NeuralNet.convnetshared1 import NNModel
+                from NeuralNet import frozen_model
+                import tune_threads
+                if profile is not None:
+                                profile.mark('import tensorflow')
+
+                def make_session(graph):
+                                # Thread counts and affinity from config, as tuned by tune_threads.py.
+                                return tune_threads.make_session(tf, graph, config.tf_intra_op_threads,
+                                                                 config.tf_inter_op_threads, config.tf_cpu_affinity)
+
+                # Prefer the frozen inference graph exported next to the checkpoint.
+                frozen_file = frozen_model.find_frozen(tmp_file) if tmp_file else None
+                if frozen_file is not None:
+                                print("Using frozen graph: {}".format(frozen_file))
+                                net_model = frozen_model.FrozenModel(frozen_file)
+                                sess = make_session(net_model.graph)
+                                if profile is not None:
+                                                profile.mark('load frozen graph')
+                                return sess, net_model
+                print("No up to date frozen graph, export one with NeuralNet/frozen_model.py")
+
+                # Only the inference part of the model, so there are no optimizer slots to restore.
+                graph = tf.Graph()
+                with graph.as_default():
+                                net_model = NNModel(inference_only=True)
+                                # Add ops to save and restore all of the variables
+                                saver = tf.train.Saver()
+                sess = make_session(graph)
 
                 # Try to restore a session
                 try:
@@ -282,19 +299,24 @@ def setup_tensorflow():
                                 print("Error restoring TF model: {}".format(tmp_file))
                                 # sys.exit(-1)
 
+                if profile is not None:
+                                profile.mark('restore checkpoint')
                 return sess, net_model
 
 
-def do_tensorflow(sess, net_model, frame, odo_ticks, vel):
-        # Resize our image from the car
-        resized = cv2.resize(frame, (128, 128))
-        assert resized.shape == (128, 128, 3)  # Must be correct size and RGB, not RGBA.
+def do_tensorflow(sess, feeder, frame, odo_ticks, vel, trace=None):
+        # Resize our image from the car straight into the feeder's input buffers.
+        assert frame.shape[2] == 3  # Must be RGB, not RGBA.
+        feeder.set_frame(frame, vel)
+        if trace is not None:
+                trace.mark('resize')
 
         # speed = logging_dict["speedometer"]
 
-        # Setup the data and run tensorflow
-        batch = TrainingData.FromRealLife(resized, odo_ticks, vel)
-        [steer_regression, throttle_regression] = sess.run([net_model.steering_regress_result, net_model.throttle_regress_result], feed_dict=batch.FeedDict(net_model))
+        # Run tensorflow
+        steer_regression, throttle_regression = feeder.run(sess)
+        if trace is not None:
+                trace.mark('infer')
         steer_regression += 90
         throttle_regression += 90
         # print(throttle_regression)
@@ -375,6 +397,46 @@ def do_tensorflow(sess, net_model, frame, odo_ticks, vel):
 #               return steering, throttle
 
 
+def warm_up(sess, feeder, num_frames, frame_shape):
+        """Runs num_frames synthetic frames through do_tensorflow before driving.
+
+        The first sess.run calls are much slower than the rest while tensorflow
+        optimizes the graph and allocates, so they should happen here and not on
+        the track. Returns the p50 and p99 latency in ms of the second half of the
+        frames, once things have settled down.
+        """
+        import numpy as np
+        rand = np.random.RandomState(1)
+        frames = [rand.randint(0, 256, frame_shape).astype(np.uint8) for _ in range(4)]
+        times = []
+        for i in range(num_frames):
+                start = time.time()
+                do_tensorflow(sess, feeder, frames[i % len(frames)], 0, 0.0)
+                times.append(time.time() - start)
+        times = np.array(times) * 1000.0
+        settled = times[len(times) // 2:]
+        p50, p99 = np.percentile(settled, 50), np.percentile(settled, 99)
+        print("Warm-up: %d frames, first %.1f ms, then p50 %.1f ms, p99 %.1f ms" % (num_frames, times[0], p50, p99))
+        return p50, p99
+
+
+def start_model_watcher(frame_shape):
+        """Loads and warms up new checkpoints in the background for CarLoop to switch to."""
+        import model_watcher
+        from NeuralNet.data_model import InferenceFeeder
+
+        def load(checkpoint):
+                sess, net_model = load_model(checkpoint)
+                return sess, net_model, InferenceFeeder(net_model)
+
+        def warm(sess, feeder):
+                return warm_up(sess, feeder, config.warmup_frames, frame_shape)
+
+        return model_watcher.ModelWatcher(find_checkpoint, load, warm, find_checkpoint(),
+                                          config.frame_budget_ms, config.model_watch_secs,
+                                          config.model_watch_settle_secs).start()
+
+
 # This checks that we are running the program that allows us to close the lid of our mac and keep running.
 def check_for_insomnia():
         print("Checking for Insomnia (necessary for everything to work during lid close)")
@@ -388,159 +450,432 @@ def check_for_insomnia():
                 sys.exit(0)
 
 
-def main():
-        # Init some vars..
-        telemetry = []
-        old_steering = 0
-        old_throttle = 0
-        old_aux1 = 0
-        steering = 90
-        throttle = 90
-        aux1 = 0
-        frame_count = 0
-        session_full_path = ''
-        last_switch = 0 # set to 1 for auto-switch
-        button_arduino_out = 0
-        currently_running = False
-        override_autonomous_control = False
-        train_on_this_image = True
-        vel = 0.0
+class Sample(object):
+        """A camera frame and the car data that goes with it, passed between stages."""
 
-        # Check for insomnia
-        #if platform.system() == "Darwin":
-        #       check_for_insomnia()
-
-        # Setup ports.
-        port_in, port_out, imu_port = setup_serial_and_reset_arduinos()
-
-        # Setup tensorflow
-        sess, net_model = setup_tensorflow()
+        def __init__(self, frame_count, frame, steering, throttle, milliseconds):
+                self.frame_count = frame_count
+                self.frame = frame
+                self.frame_seq = 0
+                self.capture_time = 0.0
+                self.steering = steering
+                self.throttle = throttle
+                self.milliseconds = milliseconds
+                self.timestamp = time.time()
+                self.record_path = None
+                self.override = False
+                self.trace = None
+                self.infer_ms = 0.0
 
-        # Start the clock.
-        print 'Awaiting switch flip..'
-
-        if we_are_autonomous:
-                print("Warning, we are intending to drive with tensorflow")
-
-        session_full_path = make_data_folder('./training-images')
-
-
-        # This block is copied from below, and is a temporary hack to make recording auto-start
-        currently_running = True
-        print '%s: Switch flipped.' % frame_count
-        if we_are_recording and (not we_are_autonomous):
-                print 'STARTING TO RECORD.'
-                print 'Folder: %s' % session_full_path
-                config.store('last_record_dir', session_full_path)
-        elif we_are_recording and we_are_autonomous:
-                session_full_path = make_data_folder('~/tf-driving-images')
-                print 'DRIVING AUTONOMOUSLY and STARTING TO RECORD'
-                print 'Folder: %s' % session_full_path
-        else:
-                print("DRIVING AUTONOMOUSLY (not recording).")
-        # Endhack
 
+class CarLoop(object):
+        """The control loop and the state carried between ticks.
 
-        while True:
-                loop_start_time = time.time()
+        tick() runs on the scheduler and captures frames. Inference, actuation and
+        recording each run on their own pipeline stage, so a slow disk write no
+        longer delays the next steering command.
+        """
 
+        def __init__(self, sess, net_model, serial_link, session_full_path, shadow_runner=None):
+                self.sess = sess
+                self.net_model = net_model
+                self.feeder = None
+                if net_model is not None:
+                        from NeuralNet.data_model import InferenceFeeder
+                        self.feeder = InferenceFeeder(net_model)
+                # Set by main() to switch to new checkpoints between frames.
+                self.model_watcher = None
+                # Runs shadow models on the frames the primary drives with.
+                self.shadow_runner = shadow_runner
+                self.serial_link = serial_link
+                self.session_full_path = session_full_path
+                # Init some vars..
+                self.telemetry = []
+                self.old_steering = 0
+                self.old_throttle = 0
+                self.old_aux1 = 0
+                self.steering = 90
+                self.throttle = 90
+                self.aux1 = 0
+                self.frame_count = 0
+                self.last_switch = 0 # set to 1 for auto-switch
+                self.button_arduino_out = 0
+                self.currently_running = False
+                self.override_autonomous_control = False
+                self.train_on_this_image = True
+                self.vel = 0.0
+                self.last_frame_seq = 0
+                self.duplicate_frames = 0
+
+                # Pipeline: capture (tick) -> infer -> actuate, with recording off to the side.
+                self.capture_throughput = pipeline.Throughput()
+                self.infer_queue = pipeline.BoundedQueue(1)
+                self.actuate_queue = pipeline.BoundedQueue(1)
+                self.shadow_queue = pipeline.BoundedQueue(1)
+                # Session files are appended in order, so they get a single writer thread.
+                record_workers = 1 if config.record_format == 'session' else config.record_workers
+                self.recorder = recorder.Recorder(self.record, record_workers,
+                                                  config.record_queue_size, config.record_drop_policy)
+                self.session_writers = {}
+                # Actuation gets each inferred sample first, then the recorder and the shadow models.
+                infer_outputs = [self.actuate_queue, pipeline.Callback(self.queue_record)]
+                if shadow_runner is not None:
+                        infer_outputs.append(self.shadow_queue)
+                self.stages = [
+                        pipeline.Stage('infer', self.infer, self.infer_queue, infer_outputs),
+                        pipeline.Stage('actuate', self.actuate, self.actuate_queue),
+                ]
+                if shadow_runner is not None:
+                        self.stages.append(pipeline.Stage('shadow', self.shadow, self.shadow_queue))
+                # Commands go out at a fixed rate from the actuator's thread, whatever the frame rate.
+                self.actuator = actuator.Actuator(serial_link, process_output, stop_car,
+                                                  config.actuator_rate_hz, config.actuator_max_age_secs)
+                # Per-frame latency from capture to serial write, dumped next to the _imu.log at the end.
+                self.tracer = tracing.Tracer()
+                self.last_report_time = scheduler.monotonic()
+
+        def start(self):
+                for stage in self.stages:
+                        stage.start()
+                self.recorder.start()
+                if we_are_autonomous:
+                        # Only the model drives. Recording leaves the outputs to the RC.
+                        self.actuator.start()
+                return self
+
+        def stop(self):
+                for stage in self.stages:
+                        stage.stop()
+                # Let the writers finish what's queued so the last frames aren't lost.
+                self.recorder.close()
+                for writer in self.session_writers.values():
+                        writer.close()
+                if self.model_watcher is not None:
+                        self.model_watcher.stop()
+                if self.shadow_runner is not None:
+                        self.shadow_runner.stop()
+                        print('Wrote shadow model predictions to %s' % self.shadow_runner.log_path)
+                self.actuator.stop()
+                self.serial_link.stop()
+                trace_path = self.session_full_path + '_trace.csv'
+                print('Wrote latency trace for %d frames to %s' % (self.tracer.dump_csv(trace_path), trace_path))
+
+        def tick(self):
                 # Switch was just flipped.
-                if last_switch != button_arduino_out:
-                        last_switch = button_arduino_out
+                if self.last_switch != self.button_arduino_out:
+                        self.last_switch = self.button_arduino_out
 
-                        if button_arduino_out == 1:
-                                currently_running = True
-                                print '%s: Switch flipped.' % frame_count
+                        if self.button_arduino_out == 1:
+                                self.currently_running = True
+                                print '%s: Switch flipped.' % self.frame_count
                                 if we_are_recording and (not we_are_autonomous):
                                         print 'STARTING TO RECORD.'
-                                        print 'Folder: %s' % session_full_path
-                                        config.store('last_record_dir', session_full_path)
+                                        print 'Folder: %s' % record_dir(self.session_full_path)
+                                        config.store('last_record_dir', record_dir(self.session_full_path))
                                 elif we_are_recording and we_are_autonomous:
-                                        session_full_path = make_data_folder('~/tf-driving-images')
+                                        self.session_full_path = make_data_folder('~/tf-driving-images')
                                         print 'DRIVING AUTONOMOUSLY and STARTING TO RECORD'
-                                        print 'Folder: %s' % session_full_path
+                                        print 'Folder: %s' % self.session_full_path
                                 else:
                                         print("DRIVING AUTONOMOUSLY (not recording).")
                         else:
-                                print("%s: Switch flipped. Recording stopped." % frame_count)
-                                override_autonomous_control = False
-                                currently_running = False
+                                print("%s: Switch flipped. Recording stopped." % self.frame_count)
+                                self.override_autonomous_control = False
+                                self.currently_running = False
 
                 # Read input data from arduinos.
-                # new_steering, new_throttle, new_aux1, button_arduino_in, button_arduino_out = (
-                #       process_input(port_in, port_out))
+                # new_steering, new_throttle, new_aux1, button_arduino_in, self.button_arduino_out = (
+                #       process_input(self.serial_link))
                 # if new_steering != None:
-                #       steering = new_steering
+                #       self.steering = new_steering
                 # if new_throttle != None:
-                #       throttle = new_throttle
+                #       self.throttle = new_throttle
                 # if new_aux1 != None:
-                #       aux1 = new_aux1
+                #       self.aux1 = new_aux1
 
 
                 # Check to see if we should stop the car via the RC during TF control.
                 # But also provide a way to re-engage autonomous control after an override.
-                if we_are_autonomous and currently_running:
-                        if (steering > 130 or steering < 50) and throttle > 130:
-                                if not override_autonomous_control:
-                                        print '%s: Detected RC override: stopping.' % frame_count
-                                        override_autonomous_control = True
-                                        if abs(aux1 - old_aux1) > 400 and override_autonomous_control:
-                                                old_aux1 = aux1
-                                                print '%s: Detected RC input: re-engaging autonomous control.' % frame_count
-                                                center_esc(port_out)
-                                                override_autonomous_control = False
-
+                if we_are_autonomous and self.currently_running:
+                        if (self.steering > 130 or self.steering < 50) and self.throttle > 130:
+                                if not self.override_autonomous_control:
+                                        print '%s: Detected RC override: stopping.' % self.frame_count
+                                        self.override_autonomous_control = True
+                                        if abs(self.aux1 - self.old_aux1) > 400 and self.override_autonomous_control:
+                                                self.old_aux1 = self.aux1
+                                                print '%s: Detected RC input: re-engaging autonomous control.' % self.frame_count
+                                                self.actuator.update(90, 90)  # 90 throttle centers the esc
+                                                self.override_autonomous_control = False
+
+                # Read a frame from the camera. Don't run the same frame through twice.
+                if config.frame_sync == 'camera':
+                        next_frame = camera_stream.wait_next(self.last_frame_seq, config.frame_timeout_secs)
+                        if next_frame is None:
+                                print('%s: No frame from the camera for %s seconds.' % (self.frame_count, config.frame_timeout_secs))
+                                return
+                        frame, frame_seq, capture_time = next_frame
+                else:
+                        frame, frame_seq, capture_time = camera_stream.read()
+                if frame_seq == self.last_frame_seq:
+                        self.duplicate_frames += 1
+                        return
+                self.last_frame_seq = frame_seq
+                self.capture_throughput.tick()
+                sample = Sample(self.frame_count, frame, self.steering, self.throttle, self.serial_link.milliseconds)
+                sample.frame_seq = frame_seq
+                sample.capture_time = capture_time
+                sample.override = self.override_autonomous_control
+                sample.trace = self.tracer.begin(self.frame_count, capture_time)
+                sample.trace.mark('tick')
+                if we_are_recording and self.currently_running:
+                        # TODO(matt): also record vel in filename for tf?
+                        sample.record_path = self.session_full_path
+                        # The camera reuses its buffer a few frames from now, but the
+                        # recorder can take longer than that to get to this one.
+                        sample.frame = frame.copy()
+
+                if we_are_autonomous and self.currently_running:
+                        # Inference hands the sample on to actuation and recording.
+                        self.infer_queue.put(sample)
+                elif sample.record_path is not None:
+                        # Nothing to send: the actuator only repeats what the model produced.
+                        self.recorder.put(sample)
+
+                if self.telemetry is not None:
+                        frames = [str(self.frame_count).zfill(5)]
+                        self.telemetry = frames + self.telemetry
+                        data_logger.log_data(self.telemetry)
+
+                now = scheduler.monotonic()
+                if now - self.last_report_time >= config.pipeline_report_secs:
+                        self.last_report_time = now
+                        print(self.report())
+
+                self.frame_count += 1
+
+        def infer(self, sample):
                 # Overwrite steering with neural net output in autonomous mode.
                 # This seems to take about 10ms.
-                if we_are_autonomous and currently_running:
-                        # Read a frame from the camera.
-                        frame = camera_stream.read()
-                        # Hard code odo_ticks for pinball purposes
-                        odo_ticks = 0
-                        steering, throttle = do_tensorflow(sess, net_model, frame, odo_ticks, vel)
-                        if ((frame_count % 25) == 0) and (vel != 0):
-                                # Simulate dropped radio frames from  rc
-                                #throttle = 0
-                                pass
-
-                if we_are_recording and currently_running:
-                        # TODO(matt): also record vel in filename for tf?
-                        # Read a frame from the camera.
-                        frame = camera_stream.read()
-                        # Save image with car data in filename.
-                        cv2.imwrite("%s/" % session_full_path +
-                                "frame_" + str(frame_count).zfill(5) +
-                                "_thr_" + str(throttle) +
-                                "_ste_" + str(steering) +
-                                "_mil_" + str(milliseconds) +
-                                ".png", frame)
-                else:
-                        frame = camera_stream.read()
-                        cv2.imwrite('/tmp/test.png', frame)
-
-                if telemetry is not None:
-                        frames = [str(frame_count).zfill(5)]
-                        telemetry = frames + telemetry
-                        data_logger.log_data(telemetry)
-
-                if override_autonomous_control:
+                # Hard code odo_ticks for pinball purposes
+                odo_ticks = 0
+                self.swap_model()
+                start = scheduler.monotonic()
+                sample.steering, sample.throttle = do_tensorflow(self.sess, self.feeder, sample.frame, odo_ticks, self.vel, sample.trace)
+                sample.infer_ms = (scheduler.monotonic() - start) * 1000.0
+                if ((sample.frame_count % 25) == 0) and (self.vel != 0):
+                        # Simulate dropped radio frames from  rc
+                        #sample.throttle = 0
+                        pass
+                self.steering, self.throttle = sample.steering, sample.throttle
+                return sample
+
+        def queue_record(self, sample):
+                # Runs on the infer stage once the sample has been handed to actuation.
+                if sample.record_path is not None:
+                        self.recorder.put(sample)
+
+        def swap_model(self):
+                # Runs on the infer stage between frames, the only place the model is used.
+                if self.model_watcher is None:
+                        return
+                swap = self.model_watcher.take()
+                if swap is None:
+                        return
+                old_sess = self.sess
+                self.sess, self.net_model, self.feeder, checkpoint = swap
+                self.model_watcher.retire(old_sess)
+                print('%s: Switched to model %s' % (self.frame_count, checkpoint))
+
+        def shadow(self, sample):
+                # Runs on its own stage after the sample went to actuation. Skip frames the
+                # camera has already reused the buffer of (recorded frames are copies).
+                if sample.record_path is None and not camera_stream.is_current(sample.frame, sample.frame_seq):
+                        return
+                self.shadow_runner.submit(sample.frame_count, sample.frame, self.vel, sample.steering,
+                                          sample.throttle, sample.infer_ms)
+
+        def actuate(self, sample):
+                if sample.override:
                         # Full brake and neutral steering.
-                        throttle, steering = 0, 90
+                        self.throttle, self.steering = 0, 90
                         #print("Sending kill command to car")
-                        stop_car(steering, throttle, port_out)
+                        self.actuator.brake()
 
                 else:
-                        # Send output data to arduinos.
-                        # process_output(old_steering, old_throttle, steering, throttle, port_out)
-                        old_steering = steering
-                        old_throttle = throttle
-
-                # Attempt to go at 30 fps. In reality, we could go slower if something hiccups.
-                seconds = time.time() - loop_start_time
-                while seconds < 1 / 30.:
-                        time.sleep(0.001)
-                        seconds = time.time() - loop_start_time
-                frame_count += 1
+                        # Send output data to arduinos. The actuator keeps repeating it until the next sample.
+                        self.actuator.update(sample.steering, sample.throttle, sample.trace)
+                        self.old_steering = sample.steering
+                        self.old_throttle = sample.throttle
+
+        def record(self, sample):
+                # Runs on a recorder thread.
+                if config.record_format == 'session':
+                        # Append the raw frame and its telemetry to the session next to the images folder.
+                        writer = self.session_writers.get(sample.record_path)
+                        if writer is None:
+                                writer = session_file.SessionWriter(record_dir(sample.record_path), sample.frame.shape,
+                                                                    config.session_compression)
+                                self.session_writers[sample.record_path] = writer
+                        writer.append(sample.frame, sample.frame_count, sample.throttle, sample.steering,
+                                      sample.milliseconds, timestamp=sample.timestamp)
+                else:
+                        import cv2
+                        # Save image with car data in filename.
+                        cv2.imwrite("%s/" % sample.record_path +
+                                "frame_" + str(sample.frame_count).zfill(5) +
+                                "_thr_" + str(sample.throttle) +
+                                "_ste_" + str(sample.steering) +
+                                "_mil_" + str(sample.milliseconds) +
+                                ".png", sample.frame)
+                sample.trace.mark('record')
+
+        def report(self):
+                lines = ['%-8s %6.1f/s  duplicate frames %d  camera %.1f fps, jitter %.1f ms' % (
+                        'capture', self.capture_throughput.rate(), self.duplicate_frames,
+                        camera_stream.fps(), camera_stream.jitter * 1000.0)]
+                lines.extend(stage.report() for stage in self.stages)
+                lines.append(self.recorder.report())
+                lines.append(self.actuator.report())
+                if self.shadow_runner is not None:
+                        lines.append(self.shadow_runner.report())
+                if self.model_watcher is not None:
+                        lines.append(self.model_watcher.report())
+                lines.append(self.serial_link.report())
+                lines.append(self.tracer.summary())
+                return '\n'.join(lines)
+
+
+def main():
+        global args, we_are_autonomous, we_are_recording, camera_stream
+        profile = tracing.StartupProfile(import_start_time)
+        profile.mark('imports')
+        session_full_path = ''
+
+        # Get args.
+        args = docopt(__doc__)
+
+        # Check the mode: recording vs TF driving vs TF driving + recording.
+        if args['record']:
+                we_are_autonomous = False
+                we_are_recording = True
+                print("\n------ Ready to record training data ------\n")
+        elif args['tf']:
+                we_are_autonomous = True
+                we_are_recording = True
+                print("\n****** READY TO DRIVE BY NEURAL NET and record data ******\n")
+                if config.record_drop_policy == pipeline.BLOCK:
+                        # A slow disk would hold up inference, and the actuator would brake the car.
+                        sys.exit("record_drop_policy 'block' is only for record mode, not while driving.")
+
+        # Where this run's frames and logs go. tf mode keeps its runs apart from training data.
+        if we_are_autonomous:
+                session_full_path = make_data_folder('~/tf-driving-images')
+        else:
+                session_full_path = make_data_folder('./training-images')
+
+        # Shadow models run in a forked process. It has to start before tensorflow is
+        # loaded, and before any thread starts or cv2 is used, which don't survive a
+        # fork on macOS. So the frame size comes from config, not the camera.
+        shadow_runner = None
+        if we_are_autonomous and config.shadow_checkpoints:
+                import shadow
+                shadow_runner = shadow.ShadowRunner(config.shadow_checkpoints, load_model,
+                                                    (config.camera_height, config.camera_width, 3),
+                                                    session_full_path + '_shadow.csv',
+                                                    config.shadow_nice, config.shadow_cpu_affinity,
+                                                    config.shadow_intra_op_threads).start()
+                profile.mark('shadow models')
+
+        # Set up camera and key watcher.
+        import camera
+        if args['--replay']:
+                # Recorded frames in place of the webcam, for running without the car.
+                camera_stream = camera.ReplayCameraStream(os.path.expanduser(args['--replay']),
+                                                          speed=float(args['--speed'])).start()
+        else:
+                camera_stream = camera.CameraStream(src=config.camera_id).start()
+        key_watcher.KeyWatcher(last_key).start()
+        profile.mark('camera')
+        if shadow_runner is not None and camera_stream.read()[0].shape != shadow_runner.frame_shape:
+                print("Not running shadow models: camera frames are %s, not %s as configured." % (
+                        camera_stream.read()[0].shape, shadow_runner.frame_shape))
+                shadow_runner.stop()
+                shadow_runner = None
+
+        # Check for insomnia
+        #if platform.system() == "Darwin":
+        #       check_for_insomnia()
+
+        # Setup ports.
+        port_in, port_out, imu_port = setup_serial_and_reset_arduinos()
+        # Reads and writes for all the ports happen on the serial service's thread.
+        serial_link = serial_service.SerialService(port_in, port_out, imu_port).start()
+        profile.mark('serial')
+
+        # Setup tensorflow. Recording doesn't need a model.
+        sess, net_model = None, None
+        if we_are_autonomous:
+                sess, net_model = setup_tensorflow(profile)
+
+        # Start the clock.
+        print 'Awaiting switch flip..'
+
+        if we_are_autonomous:
+                print("Warning, we are intending to drive with tensorflow")
+
+        car_loop = CarLoop(sess, net_model, serial_link, session_full_path, shadow_runner)
+        if we_are_autonomous:
+                # Get the slow first runs out of the way, and don't arm if inference can't keep up.
+                p50, p99 = warm_up(sess, car_loop.feeder, config.warmup_frames, camera_stream.read()[0].shape)
+                profile.mark('warm-up')
+                if p99 > config.frame_budget_ms:
+                        print("NOT ARMING: p99 inference latency %.1f ms is over the %.1f ms frame budget." % (
+                                p99, config.frame_budget_ms))
+                        car_loop.stop()
+                        sys.exit(1)
+                if config.model_watch_secs:
+                        car_loop.model_watcher = start_model_watcher(camera_stream.read()[0].shape)
+        car_loop.start()
+        profile.mark('control loop')
+        if args['--profile-startup']:
+                print(profile.report())
+
+        # This block is copied from CarLoop.tick, and is a temporary hack to make recording auto-start
+        car_loop.currently_running = True
+        print '%s: Switch flipped.' % car_loop.frame_count
+        if we_are_recording and (not we_are_autonomous):
+                print 'STARTING TO RECORD.'
+                print 'Folder: %s' % record_dir(car_loop.session_full_path)
+                config.store('last_record_dir', record_dir(car_loop.session_full_path))
+        elif we_are_recording and we_are_autonomous:
+                # Already in ~/tf-driving-images, next to the shadow model log.
+                print 'DRIVING AUTONOMOUSLY and STARTING TO RECORD'
+                print 'Folder: %s' % record_dir(car_loop.session_full_path)
+        else:
+                print("DRIVING AUTONOMOUSLY (not recording).")
+        # Endhack
+
+        if config.frame_sync == 'camera':
+                # Each tick waits for the camera's next frame, so the loop runs at the camera's rate.
+                try:
+                        # A replayed camera stops at the end of the recording.
+                        while not camera_stream.stopped:
+                                car_loop.tick()
+                finally:
+                        car_loop.stop()
+                        print(car_loop.report())
+                return
+
+        # Attempt to go at 30 fps. If a tick overruns, skip ahead to the next
+        # deadline rather than running a burst of late ticks.
+        tick_scheduler = scheduler.TickScheduler()
+        tick_scheduler.add(car_loop.tick, config.loop_rate_hz, policy=config.loop_overrun_policy)
+        try:
+                tick_scheduler.run()
+        finally:
+                car_loop.stop()
+                print('Control loop stats:\n%s' % tick_scheduler)
+                print(car_loop.report())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,139 @@
+"""Loads new checkpoints in the background so the car can switch models while driving.
+
+A thread polls for a checkpoint that's newer than the one driving (a new
+last_tf_model from training, or the same checkpoint path saved over). It
+restores it into its own graph and session, warms it up, and checks it
+against the frame budget, all off the control loop. The inference stage
+picks the result up with take() between frames, so swapping models is one
+assignment and never waits on a restore.
+"""
+
+import os
+import threading
+import time
+
+
+def checkpoint_mtime(checkpoint_path):
+  """When checkpoint_path was last saved, or None if it doesn't exist."""
+  for path in (checkpoint_path + '.index', checkpoint_path):
+    if os.path.exists(path):
+      return os.path.getmtime(path)
+  return None
+
+
+class ModelWatcher(object):
+  def __init__(self, find_func, load_func, warm_func, checkpoint, budget_ms,
+               poll_secs=2.0, settle_secs=5.0):
+    """find_func() returns the checkpoint the car should drive with now, like
+    main_car.find_checkpoint. load_func(checkpoint) returns a new (sess,
+    net_model, feeder), and warm_func(sess, feeder) warms it up and returns
+    its p50 and p99 latency in ms. checkpoint is the one already driving.
+
+    A checkpoint has to be settle_secs old before it's loaded, so training
+    has finished writing it and its frozen graph and numpy weights.
+    """
+    self.find_func = find_func
+    self.load_func = load_func
+    self.warm_func = warm_func
+    self.budget_ms = budget_ms
+    self.poll_secs = poll_secs
+    self.settle_secs = settle_secs
+    self.checkpoint = checkpoint
+    self.seen = (checkpoint, checkpoint and checkpoint_mtime(checkpoint))
+    self.lock = threading.Lock()
+    # (sess, net_model, feeder, checkpoint) ready for take(), and old sessions to close.
+    self.pending = None
+    self.retired = []
+    self.swaps = 0
+    self.rejected = 0
+    self.stopped = threading.Event()
+
+  def start(self):
+    t = threading.Thread(target=self.update, args=())
+    t.daemon = True
+    t.start()
+    return self
+
+  def update(self):
+    while not self.stopped.wait(self.poll_secs):
+      self._close_retired()
+      checkpoint = self.find_func()
+      if not checkpoint:
+        continue
+      mtime = checkpoint_mtime(checkpoint)
+      if mtime is None or (checkpoint, mtime) == self.seen:
+        continue
+      if mtime > time.time() - self.settle_secs:
+        continue
+      self.seen = (checkpoint, mtime)
+      self._load(checkpoint)
+    self._close_retired()
+
+  def _load(self, checkpoint):
+    print('ModelWatcher: loading %s' % checkpoint)
+    try:
+      sess, net_model, feeder = self.load_func(checkpoint)
+    except Exception as e:
+      self.rejected += 1
+      print('ModelWatcher: failed to load %s: %s' % (checkpoint, e))
+      return
+    try:
+      p50, p99 = self.warm_func(sess, feeder)
+    except Exception as e:
+      p50, p99 = None, None
+      print('ModelWatcher: %s failed warm-up: %s' % (checkpoint, e))
+    if p99 is None or p99 > self.budget_ms:
+      self.rejected += 1
+      if p99 is not None:
+        print('ModelWatcher: not switching to %s, p99 %.1f ms is over the %.1f ms frame budget.' % (
+          checkpoint, p99, self.budget_ms))
+      _close(sess)
+      return
+    with self.lock:
+      replaced, self.pending = self.pending, (sess, net_model, feeder, checkpoint)
+    if replaced is not None:
+      # Never picked up, a newer one beat it.
+      _close(replaced[0])
+    print('ModelWatcher: %s is ready to drive (p50 %.1f ms, p99 %.1f ms).' % (checkpoint, p50, p99))
+
+  def take(self):
+    """Returns a warmed up (sess, net_model, feeder, checkpoint) to switch to, or
+    None. Called between frames by whoever runs inference.
+    """
+    if self.pending is None:
+      return None
+    with self.lock:
+      pending, self.pending = self.pending, None
+    if pending is not None:
+      self.swaps += 1
+      self.checkpoint = pending[3]
+    return pending
+
+  def retire(self, sess):
+    """Hands over the session that was just swapped out, to be closed off the control loop."""
+    with self.lock:
+      self.retired.append(sess)
+
+  def _close_retired(self):
+    with self.lock:
+      retired, self.retired = self.retired, []
+    for sess in retired:
+      _close(sess)
+
+  def stop(self):
+    self.stopped.set()
+    with self.lock:
+      pending, self.pending = self.pending, None
+    if pending is not None:
+      _close(pending[0])
+
+  def report(self):
+    return '%-8s %s, %d swaps, %d rejected' % (
+      'model', self.checkpoint, self.swaps, self.rejected)
+
+
+def _close(sess):
+  # The numpy engine is its own session and has nothing to close.
+  close = getattr(sess, 'close', None)
+  if close is not None:
+    close()
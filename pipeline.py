@@ -0,0 +1,147 @@
+"""Threaded pipeline stages connected by bounded queues.
+
+Each stage runs on its own thread and pulls from a queue that only keeps
+the newest items, so a slow stage (like writing images to disk) drops old
+work instead of holding up the stages before it.
+"""
+
+import collections
+import threading
+
+from scheduler import monotonic
+
+
+# What BoundedQueue.put does when the queue is full.
+BLOCK = 'block'  # wait for a consumer to make room
+DROP_OLDEST = 'drop_oldest'  # throw away the oldest queued item
+DROP_NEWEST = 'drop_newest'  # throw away the item being put
+POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST)
+
+
+class BoundedQueue(object):
+  def __init__(self, maxsize=1, policy=DROP_OLDEST):
+    """A queue with a fixed size and a policy for when it's full.
+
+    The default keeps only the newest items.
+    """
+    assert maxsize >= 1
+    assert policy in POLICIES
+    self.maxsize = maxsize
+    self.policy = policy
+    self.items = collections.deque()
+    self.cond = threading.Condition()
+    self.closed = False
+    self.dropped = 0
+
+  def put(self, item):
+    """Returns False if an item (this one or an older one) was dropped."""
+    with self.cond:
+      accepted = True
+      if self.policy == BLOCK:
+        while len(self.items) >= self.maxsize and not self.closed:
+          self.cond.wait()
+      elif len(self.items) >= self.maxsize:
+        self.dropped += 1
+        accepted = False
+        if self.policy == DROP_NEWEST:
+          return accepted
+        self.items.popleft()
+      self.items.append(item)
+      self.cond.notify_all()
+      return accepted
+
+  def get(self):
+    """Blocks until there is an item. Returns None once the queue is closed
+    and empty.
+
+    There is deliberately no timeout: on Python 2 a timed wait polls with
+    sleeps of up to 50 ms, which is longer than a frame.
+    """
+    with self.cond:
+      while not self.items and not self.closed:
+        self.cond.wait()
+      if not self.items:
+        return None
+      item = self.items.popleft()
+      self.cond.notify_all()
+      return item
+
+  def close(self):
+    """Wakes up everyone waiting. Items already queued can still be read."""
+    with self.cond:
+      self.closed = True
+      self.cond.notify_all()
+
+  def depth(self):
+    return len(self.items)
+
+
+class Throughput(object):
+  """Counts items and reports the rate since the last report."""
+
+  def __init__(self):
+    self.count = 0
+    self.last_count = 0
+    self.last_time = monotonic()
+
+  def tick(self):
+    self.count += 1
+
+  def rate(self):
+    """Items per second since the last call."""
+    now = monotonic()
+    elapsed = now - self.last_time
+    rate = (self.count - self.last_count) / elapsed if elapsed > 0 else 0.0
+    self.last_count = self.count
+    self.last_time = now
+    return rate
+
+
+class Callback(object):
+  """Stands in for an output queue, calling func(item) for every item put."""
+
+  def __init__(self, func):
+    self.func = func
+
+  def put(self, item):
+    return self.func(item)
+
+
+class Stage(object):
+  def __init__(self, name, func, input_queue, output_queues=()):
+    """Calls func(item) for every item from input_queue on its own thread.
+
+    Whatever func returns, unless it's None, is put on each output queue.
+    """
+    self.name = name
+    self.func = func
+    self.input_queue = input_queue
+    self.output_queues = list(output_queues)
+    self.throughput = Throughput()
+    self.stopped = False
+
+  def start(self):
+    t = threading.Thread(target=self.update, args=())
+    t.daemon = True
+    t.start()
+    return self
+
+  def update(self):
+    while not self.stopped:
+      item = self.input_queue.get()
+      if item is None:
+        break
+      result = self.func(item)
+      self.throughput.tick()
+      if result is not None:
+        for queue in self.output_queues:
+          queue.put(result)
+
+  def stop(self):
+    self.stopped = True
+    self.input_queue.close()
+
+  def report(self):
+    return '%-8s %6.1f/s  queue %d  dropped %d' % (
+      self.name, self.throughput.rate(), self.input_queue.depth(),
+      self.input_queue.dropped)
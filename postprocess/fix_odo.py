@@ -10,6 +10,9 @@ import sys
 
 from docopt import docopt
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import recording_index
+
 
 EXPECTED_MAX_ODO = 750
 
@@ -18,7 +21,9 @@ EXPECTED_MAX_ODO = 750
 args = docopt(__doc__)
 inpath = os.path.expanduser(args['<inpath>'])
 outpath = os.path.expanduser(args['<outpath>'])
-file_count = len([f for f in os.listdir(inpath) if 'lidar' not in f])
+# Frames in order, so the odometer resets are found where they happened.
+index = recording_index.load(inpath)
+file_count = len(index)
 print '%s files' % file_count
 
 # Determine where to save.
@@ -32,15 +37,15 @@ if not os.path.exists(savedir):
 # Fix the odos..
 last_odo = None
 odo_fix = 0
-for i, filename in enumerate(os.listdir(inpath)):
+no_odo = 0
+for i, row in enumerate(index):
   # Filenames are like "frame_31464_thr_101_ste_91_mil_1070052_odo_00708.png"
-  if 'lidar' in filename:
-    continue
-  if 'frame' not in filename:
+  filename = os.path.basename(row['path'])
+  if '_odo_' not in filename:
+    # Recorded without an odometer, so there's nothing to fix.
+    no_odo += 1
     continue
-
-  _, frame, _, throttle, _, steering, _, millis, _, odo = filename.split('_')
-  odo = int(odo.split('.')[0])
+  odo = int(row['odo'])
 
   # Init last odo.
   if not last_odo:
@@ -52,11 +57,11 @@ for i, filename in enumerate(os.listdir(inpath)):
   elif odo == 0 and last_odo + odo_fix >= EXPECTED_MAX_ODO:
     odo_fix = 0
 
+  # Everything up to the odo is kept as it was written.
   new_odo = str(odo + odo_fix).zfill(5)
-  new_filename = 'frame_%s_thr_%s_ste_%s_mil_%s_odo_%s.png' % (
-    frame, throttle, steering, millis, new_odo)
+  new_filename = '%s_odo_%s.png' % (filename[:filename.rfind('_odo_')], new_odo)
 
-  source_file = os.path.join(inpath, filename)
+  source_file = row['path']
   dest_file = os.path.join(savedir, new_filename)
   shutil.copyfile(source_file, dest_file)
 
@@ -66,4 +71,6 @@ for i, filename in enumerate(os.listdir(inpath)):
     sys.stdout.write('\rprocessing.. %0.1f%%' % (100. * i / file_count))
     sys.stdout.flush()
 
+if no_odo:
+  print '\nskipped %d files without an odo value' % no_odo
 print '\ncomplete.'
@@ -6,19 +6,21 @@ Usage:
 
 import os
 import json
+import sys
 import time
 
 from docopt import docopt
 import numpy as np
 import matplotlib.pyplot as plt
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import recording_index
+
 
 # Parse args and get all filenames.
 args = docopt(__doc__)
 image_dirs = args['<image-dirs>']
-all_filenames = []
-for image_dir in image_dirs:
-  all_filenames.extend(os.listdir(image_dir))
+index = recording_index.concatenate([recording_index.load(image_dir) for image_dir in image_dirs])
 dated_dir = time.strftime('%Y_%m_%d__%I_%M_%S_%p')
 
 # Build the out path.
@@ -30,18 +32,11 @@ print 'saving to %s' % out_dir
 
 
 data = {}
-print '%s total files' % len(all_filenames)
-for filename in all_filenames:
-  if '.DS_Store' in filename:
-    continue
-  if 'lidar' in filename:
-    print 'error!'
-  # Filenames look like: frame_04162_thr_107_ste_92_mil_141348_odo_3515.png
-  _, frame, _, throttle, _, steering, _, mil, _, odo = filename.split('_')
-  throttle = int(throttle)
-  steering = int(steering)
-  if '.' in odo:
-    odo = int(odo.split('.')[0])
+print '%s total files' % len(index)
+for row in index:
+  throttle = int(row['thr'])
+  steering = int(row['ste'])
+  odo = int(row['odo'])
   # Store data, keyed by odo.
   if odo not in data:
     data[odo] = {
@@ -0,0 +1,72 @@
+"""Asynchronous recording to disk.
+
+Frames are handed to a small pool of writer threads through a bounded queue,
+so image encoding and disk writes happen off the control loop. cv2.imwrite
+releases the GIL while it encodes, so threads are enough to use more cores.
+"""
+
+import threading
+
+import pipeline
+from pipeline import DROP_OLDEST
+
+
+class Recorder(object):
+  def __init__(self, write_func, num_workers=2, maxsize=30, policy=DROP_OLDEST):
+    """Calls write_func(item) on a writer thread for every item put().
+
+    policy says what happens when the disk falls behind and the queue is
+    full: BLOCK the caller, DROP_OLDEST queued item or DROP_NEWEST item.
+    Nothing touches the disk unless something is put().
+    """
+    self.write_func = write_func
+    self.num_workers = num_workers
+    self.queue = pipeline.BoundedQueue(maxsize, policy)
+    self.throughput = pipeline.Throughput()
+    self.lock = threading.Lock()
+    self.written = 0
+    self.failed = 0
+    self.threads = []
+
+  def start(self):
+    for _ in range(self.num_workers):
+      t = threading.Thread(target=self.update, args=())
+      t.daemon = True
+      t.start()
+      self.threads.append(t)
+    return self
+
+  def update(self):
+    while True:
+      item = self.queue.get()
+      if item is None:
+        break
+      try:
+        self.write_func(item)
+      except Exception as e:
+        with self.lock:
+          self.failed += 1
+        print('Recorder: failed to write frame: %s' % e)
+        continue
+      with self.lock:
+        self.written += 1
+        self.throughput.tick()
+
+  def put(self, item):
+    """Queues item for writing. Returns False if a frame was dropped."""
+    return self.queue.put(item)
+
+  def close(self, timeout=None):
+    """Stops accepting frames and waits for the queued ones to be written."""
+    self.queue.close()
+    for t in self.threads:
+      t.join(timeout)
+
+  @property
+  def dropped(self):
+    return self.queue.dropped
+
+  def report(self):
+    return '%-8s %6.1f/s  queue %d  dropped %d  failed %d' % (
+      'record', self.throughput.rate(), self.queue.depth(), self.dropped,
+      self.failed)
@@ -0,0 +1,137 @@
+"""A parsed, cached listing of a folder of recorded frames.
+
+Recorded images are named like
+frame_02955_thr_99_ste_79_mil_100300_odo_2354.png. load() lists a folder
+once, parses every name with session_file.parse_frame_filename, the same
+as replay and import do, into a structured numpy array sorted by frame, and
+caches it next to the folder as <folder>.index.npz. The cache is used until
+the folder's mtime changes, which happens whenever a file is added, removed
+or renamed in it.
+"""
+
+import os
+import time
+
+import numpy as np
+
+import session_file
+
+try:
+  from os import scandir
+except ImportError:
+  try:
+    from scandir import scandir
+  except ImportError:
+    scandir = None
+
+
+INDEX_VERSION = 2
+
+# Fields of the index. path is the full path of the image when it's loaded,
+# and the name relative to the folder in the cache.
+FIELDS = [('frame', np.int64), ('thr', np.float64), ('ste', np.float64),
+          ('mil', np.float64), ('odo', np.int64)]
+
+# The cache isn't written for a folder changed this recently: some file
+# systems (HFS+) only keep mtimes to the second, so a frame written right
+# after the listing might not change it.
+SETTLE_SECS = 2.0
+
+
+def index_path(folder):
+  return os.path.normpath(os.path.expanduser(folder)) + '.index.npz'
+
+
+def _list_names(folder):
+  if scandir is not None:
+    return [entry.name for entry in scandir(folder)]
+  return os.listdir(folder)
+
+
+def _dtype(names):
+  width = max([len(name) for name in names] + [1])
+  return np.dtype(FIELDS + [('path', 'U%d' % width)])
+
+
+def scan(folder):
+  """Lists and parses folder without the cache. path holds names, not full paths."""
+  rows = []
+  for name in _list_names(folder):
+    parsed = session_file.parse_frame_filename(name)
+    if parsed is not None:
+      rows.append((parsed['frame'], parsed['throttle'], parsed['steering'], parsed['millis'],
+                   parsed['odo'], name))
+  index = np.array(rows, dtype=_dtype([row[-1] for row in rows]))
+  # Sorted by frame, and by name for any repeated frame numbers.
+  return index[np.lexsort((index['path'], index['frame']))]
+
+
+def _read_cache(path, mtime):
+  try:
+    with np.load(path) as cache:
+      if int(cache['version']) != INDEX_VERSION or float(cache['mtime']) != mtime:
+        return None
+      return cache['index']
+  except (IOError, OSError, ValueError, KeyError):
+    return None
+
+
+def _write_cache(path, index, mtime):
+  tmp_path = path + '.tmp'
+  try:
+    with open(tmp_path, 'wb') as fp:
+      np.savez(fp, version=INDEX_VERSION, mtime=mtime, index=index)
+    os.rename(tmp_path, path)
+  except (IOError, OSError):
+    # A read-only folder just goes without a cache.
+    pass
+
+
+def _load_session(path):
+  telemetry = session_file.SessionReader(path).telemetry
+  refs = [session_file.frame_ref(path, i) for i in range(len(telemetry))]
+  index = np.empty(len(refs), dtype=_dtype(refs))
+  index['frame'] = telemetry['frame']
+  for name, field in (('thr', 'throttle'), ('ste', 'steering')):
+    values = telemetry[field].astype(np.float64)
+    values[~np.isfinite(values)] = 0.0
+    index[name] = values
+  index['mil'] = telemetry['millis']
+  index['odo'] = telemetry['odo']
+  index['path'] = refs
+  # Recorded in frame order already. The stable sort keeps it that way.
+  return index[np.argsort(index['frame'], kind='mergesort')]
+
+
+def load(folder, use_cache=True):
+  """Returns the index of folder, sorted by frame, with full paths in path."""
+  folder = os.path.normpath(os.path.expanduser(folder))
+  if session_file.is_session(folder):
+    return _load_session(folder)
+  # Read before listing, so a frame added during the listing invalidates the cache.
+  mtime = os.stat(folder).st_mtime
+  cache_path = index_path(folder)
+  index = _read_cache(cache_path, mtime) if use_cache else None
+  if index is None:
+    index = scan(folder)
+    if use_cache and time.time() - mtime > SETTLE_SECS:
+      _write_cache(cache_path, index, mtime)
+  paths = [os.path.join(folder, name) for name in index['path']]
+  full = np.empty(len(index), dtype=_dtype(paths))
+  for name, _ in FIELDS:
+    full[name] = index[name]
+  full['path'] = paths
+  return full
+
+
+def concatenate(indexes):
+  """Joins loaded indexes end to end, keeping each one's order."""
+  paths = [path for index in indexes for path in index['path']]
+  joined = np.empty(len(paths), dtype=_dtype(paths))
+  start = 0
+  for index in indexes:
+    for name, _ in FIELDS:
+      joined[name][start:start + len(index)] = index[name]
+    start += len(index)
+  joined['path'] = paths
+  return joined
@@ -0,0 +1,194 @@
+"""Deadline driven tick scheduler.
+
+Callbacks are run at fixed rates off absolute deadlines on a monotonic clock,
+so the loop sleeps once per tick instead of spinning on short sleeps, and
+the rate doesn't drift when a tick takes a little longer than usual.
+"""
+
+import ctypes
+import ctypes.util
+import sys
+import threading
+import time
+
+
+def _ctypes_monotonic():
+  """A monotonic clock from the OS through ctypes, or None if there isn't one.
+
+  Python 2 has no monotonic clock in the standard library. time.time jumps
+  when NTP steps the clock or the laptop wakes up, which would make the
+  scheduler burst through catch-up ticks or stall.
+  """
+  if sys.platform == 'darwin':
+    libc = ctypes.CDLL(ctypes.util.find_library('c'))
+
+    class TimebaseInfo(ctypes.Structure):
+      _fields_ = [('numer', ctypes.c_uint32), ('denom', ctypes.c_uint32)]
+
+    timebase = TimebaseInfo()
+    libc.mach_timebase_info(ctypes.byref(timebase))
+    libc.mach_absolute_time.restype = ctypes.c_uint64
+    scale = 1e-9 * timebase.numer / timebase.denom
+    return lambda: libc.mach_absolute_time() * scale
+  if sys.platform.startswith('linux'):
+
+    class Timespec(ctypes.Structure):
+      _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    librt = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True)
+    clock_gettime = librt.clock_gettime
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(Timespec)]
+    CLOCK_MONOTONIC = 1
+    ts = Timespec()
+
+    def linux_monotonic():
+      if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+        raise OSError(ctypes.get_errno(), 'clock_gettime(CLOCK_MONOTONIC) failed')
+      return ts.tv_sec + ts.tv_nsec * 1e-9
+    return linux_monotonic
+  return None
+
+
+try:
+  monotonic = time.monotonic
+except AttributeError:
+  try:
+    # The backport from PyPI, if it's installed.
+    from monotonic import monotonic
+  except ImportError:
+    try:
+      monotonic = _ctypes_monotonic()
+      monotonic()
+    except (OSError, AttributeError, TypeError):
+      monotonic = None
+    if monotonic is None:
+      sys.stderr.write('WARNING: scheduler: no monotonic clock on this system, falling back to '
+                       'time.time. Clock changes and sleep will upset tick timing and the '
+                       'actuator failsafe. pip install monotonic to fix this.\n')
+      monotonic = time.time
+
+
+# What to do when a callback overruns and one or more deadlines are missed.
+# SKIP drops the missed ticks and waits for the next deadline on the grid.
+# CATCH_UP runs the missed ticks back to back (up to max_backlog of them).
+SKIP = 'skip'
+CATCH_UP = 'catch_up'
+
+
+class Task(object):
+  """A callback registered with the scheduler, plus its counters."""
+
+  def __init__(self, callback, rate_hz, policy, max_backlog):
+    assert rate_hz > 0
+    assert policy in (SKIP, CATCH_UP)
+    self.callback = callback
+    self.rate_hz = rate_hz
+    self.period = 1.0 / rate_hz
+    self.policy = policy
+    self.max_backlog = max_backlog
+    self.next_deadline = None
+    # Counters.
+    self.ticks = 0
+    self.late_ticks = 0  # started more than late_threshold after the deadline
+    self.overruns = 0  # callback took longer than one period
+    self.skipped_ticks = 0  # deadlines dropped to get back on the grid
+    self.max_lateness = 0.0
+    self.max_duration = 0.0
+
+  def stats(self):
+    return {
+      'ticks': self.ticks,
+      'late_ticks': self.late_ticks,
+      'overruns': self.overruns,
+      'skipped_ticks': self.skipped_ticks,
+      'max_lateness_ms': self.max_lateness * 1000.0,
+      'max_duration_ms': self.max_duration * 1000.0,
+    }
+
+  def __str__(self):
+    name = getattr(self.callback, '__name__', repr(self.callback))
+    return ('%s @ %.1f Hz: %d ticks, %d late, %d overruns, %d skipped, '
+            'max late %.2f ms, max duration %.2f ms' % (
+              name, self.rate_hz, self.ticks, self.late_ticks, self.overruns,
+              self.skipped_ticks, self.max_lateness * 1000.0,
+              self.max_duration * 1000.0))
+
+
+class TickScheduler(object):
+  def __init__(self, late_threshold=0.002, clock=monotonic, sleep=time.sleep):
+    """Runs registered callbacks at their rates until stopped.
+
+    late_threshold is how far past its deadline (in seconds) a tick can start
+    before it's counted as late.
+    """
+    self.late_threshold = late_threshold
+    self.clock = clock
+    self.sleep = sleep
+    self.tasks = []
+    self.stopped = False
+
+  def add(self, callback, rate_hz, policy=SKIP, max_backlog=3):
+    """Registers callback() to be called rate_hz times a second."""
+    task = Task(callback, rate_hz, policy, max_backlog)
+    self.tasks.append(task)
+    return task
+
+  def start(self):
+    """Run the scheduler on its own thread."""
+    t = threading.Thread(target=self.run, args=())
+    t.daemon = True
+    t.start()
+    return self
+
+  def run(self):
+    """Run the scheduler on the calling thread until stop() is called."""
+    assert self.tasks, 'No callbacks registered.'
+    now = self.clock()
+    for task in self.tasks:
+      task.next_deadline = now
+    while not self.stopped:
+      task = min(self.tasks, key=lambda t: t.next_deadline)
+      delay = task.next_deadline - self.clock()
+      if delay > 0:
+        self.sleep(delay)
+      self._run_task(task)
+
+  def stop(self):
+    self.stopped = True
+
+  def _run_task(self, task):
+    start = self.clock()
+    lateness = start - task.next_deadline
+    if lateness > self.late_threshold:
+      task.late_ticks += 1
+    task.max_lateness = max(task.max_lateness, lateness)
+
+    task.callback()
+
+    end = self.clock()
+    duration = end - start
+    task.ticks += 1
+    task.max_duration = max(task.max_duration, duration)
+    if duration > task.period:
+      task.overruns += 1
+
+    # Deadlines stay on a fixed grid from the start time, so small delays
+    # don't accumulate into drift.
+    task.next_deadline += task.period
+    if task.next_deadline > end:
+      return
+    missed = int((end - task.next_deadline) / task.period) + 1
+    if task.policy == CATCH_UP and missed <= task.max_backlog:
+      # The missed ticks will run back to back on the next iterations.
+      return
+    if task.policy == CATCH_UP:
+      # Too far behind to catch up, keep the last max_backlog ticks only.
+      missed -= task.max_backlog
+    task.skipped_ticks += missed
+    task.next_deadline += missed * task.period
+
+  def stats(self):
+    return [task.stats() for task in self.tasks]
+
+  def __str__(self):
+    return '\n'.join(str(task) for task in self.tasks)
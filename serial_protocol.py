@@ -0,0 +1,264 @@
+"""Parsing the line-based serial protocol the Arduinos speak.
+
+The input Arduino sends "<steering> <throttle> <aux1>" lines and "S" when its
+button is pressed. The output Arduino sends "Mil\\t<millis>",
+"Button\\t<0|1>" and "IMU ..." lines.
+
+LineParser works on raw bytes in a bytearray with a read cursor: no decoding,
+no regexes and no rebuilding the buffer string for every line. RC lines, the
+bulk of the traffic, are scanned in place without slicing or splitting them;
+Mil and Button lines slice out their one number. Garbage only costs the line
+it's on, and lines that don't parse are counted.
+
+Usage:
+  serial_protocol.py bench [<capture-file>] [--lines=<n>] [--garbage=<rate>]
+  serial_protocol.py capture <port> <capture-file> [--seconds=<s>] [--baud=<b>]
+
+Options:
+  --lines=<n>        lines of synthetic traffic when no capture is given [default: 200000]
+  --garbage=<rate>   fraction of synthetic lines with non-ascii garbage [default: 0]
+  --seconds=<s>      how long to capture for [default: 60]
+  --baud=<b>         [default: 115200]
+"""
+
+import time
+
+
+# Message kinds returned by LineParser.next_message().
+RC = 'rc'  # values[0:3] = steering, throttle, aux1
+TOGGLE = 'toggle'  # "S" from the input Arduino's button
+MILLIS = 'mil'  # values[0] = milliseconds
+BUTTON = 'button'  # values[0] = switch state
+IMU = 'imu'  # not parsed any further
+
+CR = ord('\r')
+SPACE = ord(' ')
+ZERO = ord('0')
+NINE = ord('9')
+
+
+class LineParser(object):
+  def __init__(self, max_line=256):
+    """max_line is the longest line that's believed. Anything longer without a
+    newline is garbage and gets thrown away.
+    """
+    self.buf = bytearray()
+    self.pos = 0
+    self.max_line = max_line
+    # Parsed numbers of the last message, reused for every message.
+    self.values = [0, 0, 0]
+    # Counters.
+    self.lines = 0
+    self.malformed = 0
+    self.overflows = 0
+
+  def feed(self, data):
+    """Adds bytes read from the serial port."""
+    self.buf.extend(data)
+
+  def next_message(self):
+    """Parses the next complete line.
+
+    Returns one of the message kinds, with any numbers in self.values, or
+    None when there's no complete line left. Lines that aren't messages are
+    counted in self.malformed and skipped.
+    """
+    buf = self.buf
+    while True:
+      end = buf.find(b'\n', self.pos)
+      if end < 0:
+        self._compact()
+        return None
+      start = self.pos
+      self.pos = end + 1
+      if end > start and buf[end - 1] == CR:
+        end -= 1
+      self.lines += 1
+      kind = self._parse_line(buf, start, end)
+      if kind is not None:
+        return kind
+      self.malformed += 1
+
+  def _parse_line(self, buf, start, end):
+    if end <= start:
+      return None
+    if buf.startswith(b'Mil\t', start, end):
+      return MILLIS if self._parse_field(buf, start + 4, end) else None
+    if buf.startswith(b'Button\t', start, end):
+      return BUTTON if self._parse_field(buf, start + 7, end) else None
+    if buf.startswith(b'IMU', start, end):
+      return IMU
+    if buf.startswith(b'S', start, end):
+      return TOGGLE
+    # "<int> <int> <int>", scanned in place.
+    return RC if self._parse_three_ints(buf, start, end) else None
+
+  def _parse_field(self, buf, i, end):
+    """Parses the int after "Mil\t" or "Button\t" into values[0].
+
+    Like int(line.split('\t')[1]), more fields after it are fine.
+    """
+    field_end = buf.find(b'\t', i, end)
+    if field_end < 0:
+      field_end = end
+    try:
+      self.values[0] = int(buf[i:field_end])
+    except ValueError:
+      return False
+    return True
+
+  def _parse_three_ints(self, buf, i, end):
+    """Finds the first three runs of digits separated by single spaces.
+
+    Matches what re.search(r'(\\d+) (\\d+) (\\d+)') found on the line, and
+    reads the digits straight out of buf without slicing it.
+    """
+    values = self.values
+    found = 0
+    while i < end:
+      c = buf[i]
+      if c < ZERO or c > NINE:
+        found = 0
+        i += 1
+        continue
+      value = 0
+      while i < end:
+        c = buf[i]
+        if c < ZERO or c > NINE:
+          break
+        value = value * 10 + (c - ZERO)
+        i += 1
+      values[found] = value
+      found += 1
+      if found == 3:
+        return True
+      # The run continues only if a single space and another digit follow.
+      if not (i + 1 < end and buf[i] == SPACE and ZERO <= buf[i + 1] <= NINE):
+        found = 0
+      i += 1
+    return False
+
+  def _compact(self):
+    """Drops consumed bytes, and garbage that's too long to be a line."""
+    if self.pos >= len(self.buf):
+      del self.buf[:]
+      self.pos = 0
+    elif self.pos > 4096:
+      del self.buf[:self.pos]
+      self.pos = 0
+    if len(self.buf) - self.pos > self.max_line:
+      # No newline in far too long. Resync on the next newline.
+      del self.buf[:]
+      self.pos = 0
+      self.overflows += 1
+
+  def stats(self):
+    return 'lines %d, malformed %d, overflows %d' % (self.lines, self.malformed, self.overflows)
+
+
+def synthetic_traffic(num_lines, garbage=0.0, seed=1):
+  """Traffic shaped like a recording: mostly RC and Mil lines, some IMU and
+  Button lines, and a garbage fraction of lines with bad bytes.
+  """
+  import random
+  rand = random.Random(seed)
+  lines = []
+  for i in range(num_lines):
+    if rand.random() < garbage:
+      lines.append(b'\xf0\x9f garbage\n')
+      continue
+    r = rand.random()
+    if r < 0.45:
+      lines.append(b'%d %d %d\n' % (rand.randint(1000, 2000), rand.randint(1000, 2000), rand.randint(1000, 2000)))
+    elif r < 0.9:
+      lines.append(b'Mil\t%d\n' % (i * 33))
+    elif r < 0.95:
+      lines.append(b'IMU -0.0233 -0.0109 -0.0178 0.9995 0.0000 0.0000 0.0000 0.0400 -0.0400 0.1900\n')
+    else:
+      lines.append(b'Button\t%d\n' % rand.randint(0, 1))
+  return b''.join(lines)
+
+
+def _regex_parse(data, chunk):
+  """The old process_input() approach, for comparison."""
+  import re
+  buffer_in = ''
+  count = 0
+  for i in range(0, len(data), chunk):
+    try:
+      buffer_in += data[i:i + chunk].decode('ascii')
+    except UnicodeDecodeError:
+      buffer_in = ''
+    while '\n' in buffer_in:
+      line, buffer_in = buffer_in.split('\n', 1)
+      match = re.search(r'(\d+) (\d+) (\d+)', line)
+      if match:
+        int(match.group(1))
+        int(match.group(2))
+        int(match.group(3))
+        count += 1
+      if line[0:1] == 'S':
+        count += 1
+      if line[0:3] == 'Mil':
+        int(line.split('\t')[1])
+        count += 1
+      if line[0:3] == 'IMU':
+        count += 1
+      if line[0:6] == 'Button':
+        int(line.split('\t')[1])
+        count += 1
+  return count
+
+
+def _parser_parse(data, chunk):
+  parser = LineParser()
+  count = 0
+  for i in range(0, len(data), chunk):
+    parser.feed(data[i:i + chunk])
+    kind = parser.next_message()
+    while kind is not None:
+      count += 1
+      kind = parser.next_message()
+  return count, parser
+
+
+def bench(data, chunks=(64, 1024, 8192)):
+  """Times the old regex parsing against LineParser on the same bytes, read
+  from the port chunk bytes at a time.
+  """
+  num_lines = data.count(b'\n')
+  print('%d bytes, %d lines' % (len(data), num_lines))
+  for chunk in chunks:
+    start = time.time()
+    old_count = _regex_parse(data, chunk)
+    old_time = time.time() - start
+    start = time.time()
+    new_count, parser = _parser_parse(data, chunk)
+    new_time = time.time() - start
+    print('%5d byte reads  regex:      %6.2f us/line  %d messages' % (chunk, old_time * 1e6 / num_lines, old_count))
+    print('%5d byte reads  LineParser: %6.2f us/line  %d messages (%s)' % (chunk, new_time * 1e6 / num_lines, new_count, parser.stats()))
+
+
+def capture(port_name, path, seconds, baud):
+  """Saves raw bytes from a serial port, for benchmarking on real traffic."""
+  import serial
+  port = serial.Serial(port_name, baud, timeout=0.1)
+  end = time.time() + seconds
+  with open(path, 'wb') as fp:
+    while time.time() < end:
+      fp.write(port.read(4096))
+  port.close()
+
+
+if __name__ == '__main__':
+  from docopt import docopt
+  args = docopt(__doc__)
+  if args['bench']:
+    if args['<capture-file>']:
+      with open(args['<capture-file>'], 'rb') as fp:
+        traffic = fp.read()
+    else:
+      traffic = synthetic_traffic(int(args['--lines']), float(args['--garbage']))
+    bench(traffic)
+  elif args['capture']:
+    capture(args['<port>'], args['<capture-file>'], float(args['--seconds']), int(args['--baud']))
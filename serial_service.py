@@ -0,0 +1,219 @@
+"""Serial I/O for the Arduinos on a background thread.
+
+The service owns the input, output and IMU ports. It waits on them with
+select(), parses lines as soon as bytes arrive and timestamps every message
+when it's read, so nothing depends on how often the control loop polls.
+Outbound commands for a tick are queued as one payload and written with a
+single write() call.
+
+Usage:
+  serial_service.py selftest [--ticks=<n>]
+
+Options:
+  --ticks=<n>  control loop ticks to simulate [default: 100]
+"""
+
+import collections
+import os
+import select
+import threading
+import time
+
+import serial_protocol
+from scheduler import monotonic
+
+
+class Message(object):
+  """A parsed line from one of the ports and when it arrived."""
+  __slots__ = ('port', 'kind', 'values', 'timestamp')
+
+  def __init__(self, port, kind, values, timestamp):
+    self.port = port  # 'in', 'out' or 'imu'
+    self.kind = kind  # one of the serial_protocol message kinds
+    self.values = values
+    self.timestamp = timestamp  # scheduler.monotonic() when the bytes were read
+
+
+class SerialService(object):
+  def __init__(self, port_in, port_out, imu_port=None, max_messages=1024):
+    """Any of the ports may be None if that Arduino isn't plugged in."""
+    self.ports = [(name, port, serial_protocol.LineParser())
+                  for name, port in (('in', port_in), ('out', port_out), ('imu', imu_port))
+                  if port is not None]
+    self.port_out = port_out
+    self.lock = threading.Lock()
+    # Messages since the last call to messages(), oldest first.
+    self.inbox = collections.deque(maxlen=max_messages)
+    # Latest state reported by the Arduinos, and when it was reported.
+    self.steering = None
+    self.throttle = None
+    self.aux1 = None
+    self.rc_time = 0.0
+    self.button_arduino_in = 0
+    self.button_arduino_out = 0
+    self.milliseconds = 0
+    self.milliseconds_time = 0.0
+    # Outbound payloads waiting for the service thread. The pipe wakes it up.
+    self.outbox = collections.deque()
+    self.wake_read, self.wake_write = os.pipe()
+    # Payloads queued, and payloads written or given up on, for flush().
+    self.queued = 0
+    self.done = 0
+    # Counters.
+    self.writes = 0
+    self.bytes_written = 0
+    self.write_errors = 0
+    self.stopped = False
+
+  def start(self):
+    t = threading.Thread(target=self.update, args=())
+    t.daemon = True
+    t.start()
+    return self
+
+  def update(self):
+    fds = {}
+    polled = []
+    for name, port, parser in self.ports:
+      try:
+        fds[port.fileno()] = (name, port, parser)
+      except (AttributeError, IOError, ValueError):
+        # No file descriptor (Windows), fall back to polling this port.
+        polled.append((name, port, parser))
+    timeout = 0.002 if polled else 0.1
+    while not self.stopped:
+      readable, _, _ = select.select(list(fds) + [self.wake_read], [], [], timeout)
+      now = monotonic()
+      for fd in readable:
+        if fd == self.wake_read:
+          os.read(self.wake_read, 4096)
+        else:
+          self._read(fds[fd], now)
+      for entry in polled:
+        self._read(entry, now)
+      self._flush_outbox()
+    # Anything sent just before stop() still goes out.
+    self._flush_outbox()
+
+  def _read(self, entry, now):
+    name, port, parser = entry
+    waiting = port.in_waiting
+    if not waiting:
+      return
+    parser.feed(port.read(waiting))
+    kind = parser.next_message()
+    while kind is not None:
+      self._handle(name, kind, parser.values, now)
+      kind = parser.next_message()
+
+  def _handle(self, name, kind, values, now):
+    with self.lock:
+      if kind == serial_protocol.RC:
+        self.steering, self.throttle, self.aux1 = values
+        self.rc_time = now
+      elif kind == serial_protocol.TOGGLE:
+        # This is just a toggle button
+        self.button_arduino_in = 1 - self.button_arduino_in
+      elif kind == serial_protocol.MILLIS:
+        self.milliseconds = values[0]
+        self.milliseconds_time = now
+      elif kind == serial_protocol.BUTTON:
+        self.button_arduino_out = values[0]
+      self.inbox.append(Message(name, kind, tuple(values), now))
+
+  def send(self, payload):
+    """Queues one tick's worth of commands, to be written in a single write()."""
+    if self.port_out is None or not payload:
+      return
+    with self.lock:
+      self.queued += 1
+      self.outbox.append(payload)
+    os.write(self.wake_write, b'x')
+
+  def flush(self, timeout=0.5):
+    """Waits until everything sent so far has been written. Returns False on timeout."""
+    with self.lock:
+      queued = self.queued
+    deadline = monotonic() + timeout
+    while self.done < queued:
+      if self.stopped or monotonic() > deadline:
+        return self.done >= queued
+      time.sleep(0.001)
+    return True
+
+  def _flush_outbox(self):
+    while self.outbox:
+      payload = self.outbox.popleft()
+      try:
+        self.port_out.write(payload)
+        self.port_out.flush()
+      except Exception as e:
+        self.write_errors += 1
+        self.done += 1
+        print('Serial write failed: %s' % e)
+        continue
+      self.writes += 1
+      self.bytes_written += len(payload)
+      self.done += 1
+
+  def messages(self):
+    """Returns the messages that arrived since the last call, oldest first."""
+    with self.lock:
+      messages = list(self.inbox)
+      self.inbox.clear()
+    return messages
+
+  def read_state(self):
+    """Returns (steering, throttle, aux1, button_arduino_in, button_arduino_out, milliseconds)."""
+    with self.lock:
+      return (self.steering, self.throttle, self.aux1, self.button_arduino_in,
+              self.button_arduino_out, self.milliseconds)
+
+  def stop(self):
+    self.stopped = True
+    os.write(self.wake_write, b'x')
+
+  def report(self):
+    parsers = ', '.join('%s: %s' % (name, parser.stats()) for name, _, parser in self.ports)
+    return '%-8s %d writes, %d bytes, %d errors  %s' % (
+      'serial', self.writes, self.bytes_written, self.write_errors, parsers)
+
+
+def selftest(ticks):
+  """Drives the service against a pty-backed fake Arduino."""
+  import serial
+  import fake_arduino
+
+  arduino = fake_arduino.FakeArduino().start()
+  port = serial.Serial(arduino.port_name, 115200, timeout=0.0)
+  service = SerialService(None, port).start()
+  for i in range(ticks):
+    service.send(('S%d\nD%d\nkeepalive\n' % (80 + i % 20, 95)).encode('ascii'))
+    time.sleep(1 / 30.)
+  time.sleep(0.1)
+  messages = service.messages()
+  service.stop()
+  arduino.stop()
+
+  millis = [m for m in messages if m.kind == serial_protocol.MILLIS]
+  ok = True
+  def check(what, passed):
+    print('%s %s' % ('ok  ' if passed else 'FAIL', what))
+    return passed
+  ok &= check('one write per tick (%d writes for %d ticks)' % (service.writes, ticks), service.writes == ticks)
+  ok &= check('Arduino got every command (%d steering, %d throttle, %d keepalive)' % (
+    arduino.steering_commands, arduino.throttle_commands, arduino.keepalives),
+    arduino.steering_commands == arduino.throttle_commands == arduino.keepalives == ticks)
+  ok &= check('last steering %s == %s' % (arduino.steering, 80 + (ticks - 1) % 20), arduino.steering == 80 + (ticks - 1) % 20)
+  ok &= check('Mil messages arrived (%d)' % len(millis), len(millis) > 0)
+  ok &= check('timestamps increase', all(a.timestamp <= b.timestamp for a, b in zip(messages, messages[1:])))
+  print(service.report())
+  return ok
+
+
+if __name__ == '__main__':
+  import sys
+  from docopt import docopt
+  args = docopt(__doc__)
+  if args['selftest']:
+    sys.exit(0 if selftest(int(args['--ticks'])) else 1)
@@ -0,0 +1,305 @@
+"""Append-only session files for recorded frames and telemetry.
+
+A session is a directory holding:
+  header.json       frame shape, compression and chunk size
+  frames_NNNNN.bin  frames appended back to back, chunk_frames per file
+  telemetry.bin     one TELEMETRY_DTYPE record per frame, appended
+
+Uncompressed frames can be memory-mapped and sliced without decoding
+anything. Telemetry is written after its frame, so after a crash every
+telemetry row still points at a complete frame.
+
+Usage:
+  session_file.py import <png-folder> <session-path> [--compression=<c>]
+  session_file.py info <session-path>
+
+Options:
+  --compression=<c>  none or zlib [default: none]
+
+Examples:
+  python session_file.py import ~/training-images/2017_10_01__01_02_03_PM /tmp/lap1.session
+"""
+
+import json
+import math
+import os
+import zlib
+
+import numpy as np
+
+
+HEADER_FILE = 'header.json'
+TELEMETRY_FILE = 'telemetry.bin'
+FRAMES_FILE = 'frames_%05d.bin'
+VERSION = 1
+
+TELEMETRY_DTYPE = np.dtype([
+  ('frame', '<i4'),
+  ('throttle', '<f4'),
+  ('steering', '<f4'),
+  ('millis', '<i8'),
+  ('odo', '<i4'),
+  ('timestamp', '<f8'),  # seconds since the epoch when the frame was captured
+  ('chunk', '<i4'),  # frames_NNNNN.bin that holds the frame
+  ('offset', '<i8'),  # byte offset of the frame in its chunk
+  ('nbytes', '<i4'),  # stored size of the frame (differs from raw when compressed)
+])
+
+COMPRESSIONS = ('none', 'zlib')
+
+
+class SessionWriter(object):
+  def __init__(self, path, frame_shape, compression='none', chunk_frames=1024):
+    """Creates a new session at path for frames of shape frame_shape (uint8)."""
+    assert compression in COMPRESSIONS
+    if os.path.exists(os.path.join(path, HEADER_FILE)):
+      raise IOError('Session already exists: %s' % path)
+    if not os.path.exists(path):
+      os.makedirs(path)
+    self.path = path
+    self.frame_shape = tuple(int(d) for d in frame_shape)
+    self.frame_bytes = int(np.prod(self.frame_shape))
+    self.compression = compression
+    self.chunk_frames = chunk_frames
+    with open(os.path.join(path, HEADER_FILE), 'w') as fp:
+      json.dump({
+        'version': VERSION,
+        'frame_shape': list(self.frame_shape),
+        'dtype': 'uint8',
+        'compression': compression,
+        'chunk_frames': chunk_frames,
+      }, fp, indent=4)
+    self.telemetry_file = open(os.path.join(path, TELEMETRY_FILE), 'ab')
+    # One record, reused for every append.
+    self.record = np.zeros(1, dtype=TELEMETRY_DTYPE)
+    self.count = 0
+    self.chunk = -1
+    self.chunk_file = None
+    self.chunk_offset = 0
+
+  def append(self, frame, frame_count, throttle, steering, millis, odo=0, timestamp=0.0):
+    """Appends one frame and its telemetry."""
+    assert frame.shape == self.frame_shape and frame.dtype == np.uint8, (
+      'Expected a uint8 frame of shape %s' % (self.frame_shape,))
+    chunk = self.count // self.chunk_frames
+    if chunk != self.chunk:
+      self._open_chunk(chunk)
+    if self.compression == 'zlib':
+      data = zlib.compress(np.ascontiguousarray(frame).tobytes(), 1)
+      self.chunk_file.write(data)
+      nbytes = len(data)
+    else:
+      np.ascontiguousarray(frame).tofile(self.chunk_file)
+      nbytes = self.frame_bytes
+    # The frame has to hit the file before the telemetry row that points at it.
+    self.chunk_file.flush()
+
+    record = self.record
+    record['frame'] = frame_count
+    record['throttle'] = throttle
+    record['steering'] = steering
+    record['millis'] = millis
+    record['odo'] = odo
+    record['timestamp'] = timestamp
+    record['chunk'] = chunk
+    record['offset'] = self.chunk_offset
+    record['nbytes'] = nbytes
+    self.telemetry_file.write(self.record.tobytes())
+    self.telemetry_file.flush()
+
+    self.chunk_offset += nbytes
+    self.count += 1
+
+  def _open_chunk(self, chunk):
+    if self.chunk_file is not None:
+      self.chunk_file.close()
+    self.chunk = chunk
+    self.chunk_file = open(os.path.join(self.path, FRAMES_FILE % chunk), 'ab')
+    self.chunk_offset = 0
+
+  def close(self):
+    if self.chunk_file is not None:
+      self.chunk_file.close()
+      self.chunk_file = None
+    self.telemetry_file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+
+class SessionReader(object):
+  def __init__(self, path):
+    """Opens a session for reading. Telemetry is memory-mapped."""
+    self.path = path
+    with open(os.path.join(path, HEADER_FILE), 'r') as fp:
+      header = json.load(fp)
+    assert header['version'] == VERSION, 'Unknown session version: %s' % header['version']
+    self.frame_shape = tuple(header['frame_shape'])
+    self.frame_bytes = int(np.prod(self.frame_shape))
+    self.compression = header['compression']
+    self.chunk_frames = header['chunk_frames']
+
+    telemetry_path = os.path.join(path, TELEMETRY_FILE)
+    # Ignore a partial record at the end from a crash mid-write.
+    count = os.path.getsize(telemetry_path) // TELEMETRY_DTYPE.itemsize
+    if count > 0:
+      self.telemetry = np.memmap(telemetry_path, dtype=TELEMETRY_DTYPE, mode='r', shape=(count,))
+    else:
+      self.telemetry = np.zeros(0, dtype=TELEMETRY_DTYPE)
+    self.chunks = {}
+
+  def __len__(self):
+    return len(self.telemetry)
+
+  def _chunk(self, chunk):
+    if chunk not in self.chunks:
+      chunk_path = os.path.join(self.path, FRAMES_FILE % chunk)
+      if self.compression == 'none':
+        self.chunks[chunk] = np.memmap(chunk_path, dtype=np.uint8, mode='r')
+      else:
+        with open(chunk_path, 'rb') as fp:
+          self.chunks[chunk] = fp.read()
+    return self.chunks[chunk]
+
+  def frame(self, index):
+    """Returns frame index. Uncompressed frames are views into the file."""
+    record = self.telemetry[index]
+    data = self._chunk(int(record['chunk']))
+    offset = int(record['offset'])
+    if self.compression == 'zlib':
+      raw = zlib.decompress(data[offset:offset + int(record['nbytes'])])
+      return np.frombuffer(raw, dtype=np.uint8).reshape(self.frame_shape)
+    return data[offset:offset + self.frame_bytes].reshape(self.frame_shape)
+
+  def frames(self, start=0, stop=None):
+    """Returns frames [start, stop) as one (n, h, w, c) array.
+
+    Uncompressed frames that live in the same chunk come back as a view
+    without copying. Otherwise the frames are copied into a new array.
+    """
+    start, stop, _ = slice(start, stop).indices(len(self))
+    if stop <= start:
+      return np.zeros((0,) + self.frame_shape, dtype=np.uint8)
+    chunks = self.telemetry['chunk'][start:stop]
+    if self.compression == 'none' and chunks[0] == chunks[-1]:
+      data = self._chunk(int(chunks[0]))
+      offset = int(self.telemetry['offset'][start])
+      return data[offset:offset + (stop - start) * self.frame_bytes].reshape(
+        (stop - start,) + self.frame_shape)
+    result = np.empty((stop - start,) + self.frame_shape, dtype=np.uint8)
+    for i in range(start, stop):
+      result[i - start] = self.frame(i)
+    return result
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield self.telemetry[i], self.frame(i)
+
+
+def is_session(path):
+  return os.path.exists(os.path.join(path, HEADER_FILE))
+
+
+def frame_ref(path, index):
+  """A stand-in file path for frame index of the session at path, for code
+  that lists frames as paths (recording_index, filemash).
+  """
+  return os.path.join(path, '@%d' % index)
+
+
+def parse_frame_ref(ref):
+  """Returns (session path, index) for a frame_ref(), or None for other paths."""
+  path, name = os.path.split(ref)
+  if not name.startswith('@') or not name[1:].isdigit():
+    return None
+  return path, int(name[1:])
+
+
+def _parse_good_float(s):
+  # Missing, garbled or non-finite values are 0, as filemash always had them.
+  try:
+    value = float(s)
+  except (TypeError, ValueError):
+    return 0.0
+  return value if not (math.isnan(value) or math.isinf(value)) else 0.0
+
+
+def parse_frame_filename(filename):
+  """Parses frame_XXXXX_thr_T_ste_S_mil_M[_odo_O].png (or .jpg) into a dict.
+
+  Replay, import and training (through recording_index) all parse names
+  here. Returns None for files that aren't frame images, including lidar
+  frames. Any value but the frame number may be missing or garbled, and
+  is then 0.
+  """
+  name = os.path.basename(filename)
+  if (not name.startswith('frame_') or 'lidar' in name or
+      not name.lower().endswith(('.png', '.jpg'))):
+    return None
+  s = os.path.splitext(name)[0].split('_')
+  values = dict(zip(s[0::2], s[1::2]))
+  try:
+    frame = int(values['frame'])
+  except ValueError:
+    return None
+  return {
+    'frame': frame,
+    'throttle': _parse_good_float(values.get('thr')),
+    'steering': _parse_good_float(values.get('ste')),
+    'millis': _parse_good_float(values.get('mil')),
+    'odo': int(_parse_good_float(values.get('odo'))),
+  }
+
+
+def import_png_folder(folder, session_path, compression='none'):
+  """Converts a folder of frame_..._thr_..._ste_..._mil_... images to a session.
+
+  Frames are read with cv2 so they stay in the BGR order the car records in.
+  """
+  import cv2
+
+  frames = []
+  for filename in os.listdir(folder):
+    parsed = parse_frame_filename(filename)
+    if parsed is not None:
+      frames.append((parsed['frame'], filename, parsed))
+  frames.sort()
+  if not frames:
+    raise IOError('No frames found in %s' % folder)
+
+  writer = None
+  for i, (_, filename, parsed) in enumerate(frames):
+    path = os.path.join(folder, filename)
+    image = cv2.imread(path)
+    if image is None:
+      print('failed to read file: %s' % path)
+      continue
+    if writer is None:
+      writer = SessionWriter(session_path, image.shape, compression)
+    writer.append(image, parsed['frame'], parsed['throttle'], parsed['steering'],
+                  parsed['millis'], parsed['odo'], os.path.getmtime(path))
+    if i % 1000 == 999:
+      print('imported %d / %d frames' % (i + 1, len(frames)))
+  if writer is None:
+    raise IOError('None of the frames in %s could be read' % folder)
+  writer.close()
+  return writer.count
+
+
+if __name__ == '__main__':
+  from docopt import docopt
+  args = docopt(__doc__)
+  if args['import']:
+    count = import_png_folder(os.path.expanduser(args['<png-folder>']),
+                              os.path.expanduser(args['<session-path>']),
+                              args['--compression'])
+    print('imported %d frames to %s' % (count, args['<session-path>']))
+  elif args['info']:
+    reader = SessionReader(os.path.expanduser(args['<session-path>']))
+    print('%d frames of %s, compression %s' % (len(reader), reader.frame_shape, reader.compression))
+    if len(reader):
+      t = reader.telemetry
+      print('frames %d..%d, millis %d..%d' % (t['frame'][0], t['frame'][-1], t['millis'][0], t['millis'][-1]))
@@ -0,0 +1,120 @@
+"""Runs shadow models on the car's frames in a worker process, for comparing checkpoints.
+
+The primary model drives. Shadow models see the same frames in a separate
+process, niced and pinned to spare cores, and only get a frame when they've
+finished the last one. Frames go through a shared memory slot, so handing
+one over is a memcpy and never waits on the worker. Each frame the shadows
+run on is logged as one CSV row with the primary's prediction and latency
+next to every shadow's.
+"""
+
+import ctypes
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+
+def _worker(checkpoints, load_func, frame_shape, frame_buf, meta, ready, idle, stopped,
+            log_path, nice, cpus, intra_op_threads):
+  import config
+  if nice:
+    os.nice(nice)
+  if cpus:
+    if hasattr(os, 'sched_setaffinity'):
+      os.sched_setaffinity(0, cpus)
+    else:
+      print('WARNING: shadow models can run on any core, this Python can\'t set CPU affinity.')
+  # Applies to the sessions load_func makes in this process only.
+  config.tf_intra_op_threads = intra_op_threads
+  config.tf_inter_op_threads = 1
+  config.tf_cpu_affinity = None
+  from NeuralNet.data_model import InferenceFeeder
+  models = []
+  for checkpoint in checkpoints:
+    sess, net_model = load_func(checkpoint)
+    models.append((sess, InferenceFeeder(net_model)))
+  frame = np.frombuffer(frame_buf, dtype=np.uint8).reshape(frame_shape)
+  with open(log_path, 'w') as fp:
+    columns = ['frame', 'steering', 'throttle', 'infer_ms']
+    for i in range(len(models)):
+      columns.extend('shadow%d_%s' % (i, name) for name in ('steering', 'throttle', 'infer_ms'))
+    fp.write(','.join(columns) + '\n')
+    idle.set()
+    while not stopped.is_set():
+      if not ready.wait(0.5):
+        continue
+      ready.clear()
+      frame_count, vel, steering, throttle, infer_ms = meta[:]
+      row = ['%d' % frame_count, '%.2f' % steering, '%.2f' % throttle, '%.2f' % infer_ms]
+      for sess, feeder in models:
+        start = time.time()
+        feeder.set_frame(frame, vel)
+        shadow_steering, shadow_throttle = feeder.run(sess)
+        row.extend(['%.2f' % (shadow_steering + 90), '%.2f' % (shadow_throttle + 90),
+                    '%.2f' % ((time.time() - start) * 1000.0)])
+      fp.write(','.join(row) + '\n')
+      idle.set()
+  for sess, _ in models:
+    close = getattr(sess, 'close', None)
+    if close is not None:
+      close()
+
+
+class ShadowRunner(object):
+  def __init__(self, checkpoints, load_func, frame_shape, log_path, nice=10, cpus=None,
+               intra_op_threads=1):
+    """load_func(checkpoint) returns (sess, net_model), like main_car.load_model.
+
+    Make and start it before tensorflow is loaded, any thread is started or
+    cv2 is used in this process: the worker is forked, and none of those
+    survive a fork (cv2 and threads only on macOS).
+    """
+    self.checkpoints = list(checkpoints)
+    self.frame_shape = tuple(frame_shape)
+    self.frame_buf = multiprocessing.RawArray(ctypes.c_uint8, int(np.prod(self.frame_shape)))
+    self.frame = np.frombuffer(self.frame_buf, dtype=np.uint8).reshape(self.frame_shape)
+    # frame count, velocity, primary steering, throttle and inference ms.
+    self.meta = multiprocessing.RawArray(ctypes.c_double, 5)
+    self.ready = multiprocessing.Event()
+    self.idle = multiprocessing.Event()
+    self.stopped = multiprocessing.Event()
+    self.process = multiprocessing.Process(target=_worker, args=(
+      self.checkpoints, load_func, self.frame_shape, self.frame_buf, self.meta, self.ready,
+      self.idle, self.stopped, log_path, nice, cpus, intra_op_threads))
+    self.process.daemon = True
+    self.log_path = log_path
+    self.submitted = 0
+    self.skipped = 0
+
+  def start(self):
+    for i, checkpoint in enumerate(self.checkpoints):
+      print('Shadow model %d: %s' % (i, checkpoint))
+    self.process.start()
+    return self
+
+  def submit(self, frame_count, frame, vel, steering, throttle, infer_ms):
+    """Hands a frame and the primary's result to the shadows if they're free.
+    Returns False if they're still busy, or loading, and the frame is skipped.
+    """
+    if not self.idle.is_set():
+      self.skipped += 1
+      return False
+    self.idle.clear()
+    self.frame[...] = frame
+    self.meta[:] = [frame_count, vel, steering, throttle, infer_ms]
+    self.ready.set()
+    self.submitted += 1
+    return True
+
+  def stop(self, timeout=5.0):
+    self.stopped.set()
+    self.process.join(timeout)
+    if self.process.is_alive():
+      self.process.terminate()
+
+  def report(self):
+    return '%-8s %d models, %d frames, %d skipped  %s' % (
+      'shadow', len(self.checkpoints), self.submitted, self.skipped,
+      'running' if self.process.is_alive() else 'NOT RUNNING')
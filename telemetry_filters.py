@@ -0,0 +1,89 @@
+"""Whole-array clean-up of the steering, throttle and odometer telemetry.
+
+These used to run one frame at a time inside filemash. They take arrays (or
+lists) in frame order and give back exactly what those loops did, so they can
+be shared by filemash, the analysis scripts and the car.
+"""
+
+import collections
+
+import numpy as np
+
+
+def is_bad_signal(values):
+  """Where the RC receiver dropped the signal: a 0 or a pinned >= 179 value."""
+  values = np.asarray(values)
+  return (values == 0) | (values >= 179)
+
+
+def _fix_bad_signal_at(arr, index):
+  # The original per-frame fixes, for the few frames fix_bad_signal can't do as a whole.
+  if 2 <= index < len(arr) - 2 and (arr[index] == 0 or arr[index] >= 179):
+    arr[index] = arr[index - 1]
+
+
+def _fix_very_bad_signal_at(arr, index):
+  if 3 <= index < len(arr) - 3 and (arr[index] == 0 or arr[index] >= 179):
+    arr[index] = arr[index - 1]
+    arr[index + 1] = arr[index + 2]
+
+
+def fix_bad_signal(values):
+  """Replaces dropped RC values with the last good one before them.
+
+  Same result as running the bad and very bad signal fixes frame by frame,
+  each seeing the frames before it already fixed. Returns a new float array.
+  """
+  arr = np.array(values, dtype=np.float64)
+  n = len(arr)
+  # Frame by frame, a bad value copies the (already fixed) one before it, so
+  # runs of bad values fill forward from the last good one. The very bad fix
+  # only changes anything while that is bad too, which can only happen in a
+  # run of bad values from frame 1. Do that run the slow way.
+  start = 0
+  while start < n:
+    _fix_bad_signal_at(arr, start)
+    _fix_very_bad_signal_at(arr, start)
+    start += 1
+    if start > 2 and not (arr[start - 1] == 0 or arr[start - 1] >= 179):
+      break
+  # Everything after it fills forward, except the last two frames, which are never fixed.
+  index = np.arange(n)
+  keep = ~is_bad_signal(arr) | (index < start) | (index >= n - 2)
+  source = np.maximum.accumulate(np.where(keep, index, 0)) if n else index
+  return arr[source]
+
+
+def odometer_velocity(odos, millis, odo_delta):
+  """Odometer ticks per millisecond, looking odo_delta frames back.
+
+  0 for the first odo_delta + 1 frames, and wherever the odometer didn't move
+  forward, the lookback frame was all zeros or no time passed.
+  """
+  assert odo_delta > 0
+  odos = np.asarray(odos, dtype=np.int64)
+  millis = np.asarray(millis, dtype=np.float64)
+  n = len(odos)
+  last_odo = np.zeros(n, dtype=np.int64)
+  last_millis = np.zeros(n, dtype=np.float64)
+  if n > odo_delta + 1:
+    last_odo[odo_delta + 1:] = odos[1:n - odo_delta]
+    last_millis[odo_delta + 1:] = millis[1:n - odo_delta]
+  moved = ((odos != last_odo) & (millis != last_millis) & (last_odo < odos) &
+           ~((last_millis == 0) & (last_odo == 0)))
+  vel = np.zeros(n, dtype=np.float64)
+  vel[moved] = (odos[moved] - last_odo[moved]) / (millis[moved] - last_millis[moved])
+  if n and not moved.any():
+    # The loop only made floats for frames that moved. Keep the saved dtype the same.
+    return vel.astype(np.int64)
+  return vel
+
+
+def delta_counts(values, skip=3):
+  """collections.Counter of abs(int(a) - int(b)) over consecutive values, from frame skip on."""
+  values = np.asarray(values)
+  if len(values) <= skip:
+    return collections.Counter()
+  ints = values.astype(np.int64)
+  deltas, counts = np.unique(np.abs(ints[skip - 1:-1] - ints[skip:]), return_counts=True)
+  return collections.Counter(dict(zip(deltas.tolist(), counts.tolist())))
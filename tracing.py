@@ -0,0 +1,152 @@
+"""Per-frame latency tracing, from camera capture to the serial write.
+
+Every frame gets a FrameTrace when the control loop picks it up. Stages
+mark it as the frame passes through them, and each mark is stored as the
+time since the camera captured the frame. Tracer keeps a streaming
+histogram per stage for p50/p95/p99, and the per-frame rows for a CSV dump
+at the end of a session.
+"""
+
+import collections
+import math
+import threading
+import time
+
+from scheduler import monotonic
+
+
+# Stages in the order a frame goes through them. 'capture' is when the camera
+# read the frame, 'tick' when the control loop got it, 'write' when its
+# command went to the serial thread and 'record' when it was saved.
+STAGES = ('capture', 'tick', 'resize', 'infer', 'write', 'record')
+
+
+class LatencyHistogram(object):
+  def __init__(self, min_value=1e-5, max_value=10.0, ratio=1.05):
+    """Log-spaced buckets from min_value to max_value seconds. Each bucket is
+    ratio times wider than the last, so percentiles are within 5% by default.
+    """
+    self.min_value = min_value
+    self.log_ratio = math.log(ratio)
+    self.ratio = ratio
+    self.counts = [0] * (int(math.log(max_value / min_value) / self.log_ratio) + 2)
+    self.count = 0
+    self.total = 0.0
+    self.max = 0.0
+
+  def add(self, value):
+    if value <= self.min_value:
+      bucket = 0
+    else:
+      bucket = min(len(self.counts) - 1,
+                   int(math.log(value / self.min_value) / self.log_ratio) + 1)
+    self.counts[bucket] += 1
+    self.count += 1
+    self.total += value
+    self.max = max(self.max, value)
+
+  def percentile(self, p):
+    """Upper edge of the bucket holding the p-th percentile (0-100)."""
+    if self.count == 0:
+      return 0.0
+    target = p / 100.0 * self.count
+    seen = 0
+    for bucket, count in enumerate(self.counts):
+      seen += count
+      if seen >= target and count:
+        return min(self.max, self.min_value * self.ratio ** bucket)
+    return self.max
+
+  def mean(self):
+    return self.total / self.count if self.count else 0.0
+
+
+class FrameTrace(object):
+  """Stage times for one frame, in seconds after capture."""
+  __slots__ = ('tracer', 'frame', 'capture_time', 'times')
+
+  def __init__(self, tracer, frame, capture_time):
+    self.tracer = tracer
+    self.frame = frame
+    self.capture_time = capture_time
+    self.times = [None] * len(tracer.stages)
+
+  def mark(self, stage, now=None):
+    """Records that the frame reached stage now (on the scheduler.monotonic clock)."""
+    self.tracer.mark(self, stage, now)
+
+
+class Tracer(object):
+  def __init__(self, stages=STAGES, max_frames=100000):
+    """Keeps per-frame rows for the latest max_frames frames. Histograms
+    cover every frame.
+    """
+    self.stages = stages
+    self.stage_index = dict((stage, i) for i, stage in enumerate(stages))
+    self.histograms = [LatencyHistogram() for _ in stages]
+    self.frames = collections.deque(maxlen=max_frames)
+    self.lock = threading.Lock()
+
+  def begin(self, frame, capture_time):
+    """Starts tracing a frame captured at capture_time, and marks 'capture'."""
+    trace = FrameTrace(self, frame, capture_time)
+    with self.lock:
+      self.frames.append(trace)
+    self.mark(trace, self.stages[0], capture_time)
+    return trace
+
+  def mark(self, trace, stage, now=None):
+    if now is None:
+      now = monotonic()
+    i = self.stage_index[stage]
+    elapsed = now - trace.capture_time
+    with self.lock:
+      if trace.times[i] is None:
+        trace.times[i] = elapsed
+        self.histograms[i].add(elapsed)
+
+  def summary(self):
+    lines = ['%-8s %8s %8s %8s %8s %8s' % ('latency', 'frames', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms')]
+    with self.lock:
+      for stage, hist in zip(self.stages, self.histograms):
+        if stage == self.stages[0] or not hist.count:
+          continue
+        lines.append('%-8s %8d %8.1f %8.1f %8.1f %8.1f' % (
+          stage, hist.count, hist.percentile(50) * 1000.0, hist.percentile(95) * 1000.0,
+          hist.percentile(99) * 1000.0, hist.max * 1000.0))
+    return '\n'.join(lines)
+
+  def dump_csv(self, path):
+    """Writes one row per frame: the frame number, then ms after capture for
+    each stage (empty if the frame never reached it).
+    """
+    with self.lock:
+      frames = list(self.frames)
+    with open(path, 'w') as fp:
+      fp.write(','.join(('frame',) + tuple('%s_ms' % stage for stage in self.stages[1:])) + '\n')
+      for trace in frames:
+        fp.write('%d,%s\n' % (trace.frame, ','.join(
+          '' if t is None else '%.3f' % (t * 1000.0) for t in trace.times[1:])))
+    return len(frames)
+
+
+class StartupProfile(object):
+  """Wall clock time of each step of starting up."""
+
+  def __init__(self, start_time=None):
+    """start_time is when the first step started, time.time() by default."""
+    self.start_time = time.time() if start_time is None else start_time
+    self.last_time = self.start_time
+    self.steps = []
+
+  def mark(self, name):
+    """Ends the step called name, which started at the previous mark."""
+    now = time.time()
+    self.steps.append((name, now - self.last_time))
+    self.last_time = now
+
+  def report(self):
+    lines = ['%-20s %8s' % ('startup', 'ms')]
+    lines.extend('%-20s %8.0f' % (name, seconds * 1000.0) for name, seconds in self.steps)
+    lines.append('%-20s %8.0f' % ('total', (self.last_time - self.start_time) * 1000.0))
+    return '\n'.join(lines)
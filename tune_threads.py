@@ -0,0 +1,219 @@
+"""Finds the tensorflow thread counts and CPU affinity that run one frame fastest.
+
+Sweeps intra-op and inter-op thread counts (and, where the OS supports it,
+which cores tensorflow's threads may run on) for single-frame inference,
+with the camera thread capturing alongside the way it does on the car. The
+setting with the lowest p99 latency is written to local_config.py, and
+main_car.py's setup_tensorflow() applies it.
+
+Tensorflow's thread pools are shared by every session in a process and made
+with the first one, so each setting is timed in a fresh process running
+'tune_threads.py measure', which prints its p50 and p99.
+
+Usage:
+  tune_threads.py [<checkpoint>] [--runs=<n>] [--replay=<path>] [--no-camera] [--dry-run]
+  tune_threads.py measure <intra> <inter> <cpus> [<checkpoint>] [--runs=<n>] [--replay=<path>] [--no-camera]
+
+Options:
+  --runs=<n>       timed sess.run calls per setting [default: 200]
+  --replay=<path>  replay a recording for the camera thread instead of using the webcam
+  --no-camera      don't run a camera thread alongside
+  --dry-run        print the best setting without writing local_config.py
+
+<cpus> is a comma separated list of cores, or 'all'. Without a checkpoint
+the model gets random weights, which time the same.
+"""
+
+import multiprocessing
+import os
+import re
+import subprocess
+import sys
+import time
+
+import config
+
+LOCAL_CONFIG = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'local_config.py')
+
+
+def make_session(tf, graph=None, intra_op_threads=0, inter_op_threads=0, cpus=None):
+  """Creates a tf.Session with the given thread counts (0 is tensorflow's default).
+
+  Tensorflow starts its thread pools when the session is made, and they
+  inherit the affinity of the thread making it. So the calling thread is
+  pinned to cpus just for that, and threads started later aren't affected.
+
+  The pools belong to the process: the first session made in it sets the
+  thread counts and affinity, and later sessions share those pools whatever
+  they ask for.
+  """
+  tf_config = tf.ConfigProto(device_count={'GPU': config.should_use_gpu},
+                             intra_op_parallelism_threads=intra_op_threads,
+                             inter_op_parallelism_threads=inter_op_threads)
+  if not cpus or not hasattr(os, 'sched_setaffinity'):
+    return tf.Session(graph=graph, config=tf_config)
+  old_cpus = os.sched_getaffinity(0)
+  os.sched_setaffinity(0, cpus)
+  try:
+    return tf.Session(graph=graph, config=tf_config)
+  finally:
+    os.sched_setaffinity(0, old_cpus)
+
+
+def _settings():
+  """(intra_op_threads, inter_op_threads, cpus) combinations to try."""
+  all_cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else None
+  num_cpus = len(all_cpus) if all_cpus else multiprocessing.cpu_count()
+  thread_counts = sorted(set([0, 1, 2, num_cpus // 2, num_cpus - 1, num_cpus]))
+  cpu_sets = [None]
+  if all_cpus and len(all_cpus) > 1:
+    # Leave the first core to the camera, key watcher and control loop.
+    cpu_sets.append(all_cpus[1:])
+  for cpus in cpu_sets:
+    for intra in thread_counts:
+      if cpus and intra > len(cpus):
+        continue
+      for inter in (0, 1, 2):
+        yield intra, inter, cpus
+
+
+def _load_model(tf, checkpoint):
+  """Returns (graph, model, init) with init(sess) restoring or initializing the
+  weights. Uses the checkpoint's frozen graph if it has one, like the car does.
+  """
+  from NeuralNet import frozen_model
+  from NeuralNet.convnetshared1 import NNModel
+  frozen_file = frozen_model.find_frozen(checkpoint) if checkpoint else None
+  if frozen_file is not None:
+    print('Using frozen graph: %s' % frozen_file)
+    model = frozen_model.FrozenModel(frozen_file)
+    return model.graph, model, lambda sess: None
+  graph = tf.Graph()
+  with graph.as_default():
+    model = NNModel(inference_only=True)
+    if checkpoint:
+      saver = tf.train.Saver()
+      init = lambda sess: saver.restore(sess, checkpoint)
+    else:
+      init_op = tf.global_variables_initializer()
+      init = lambda sess: sess.run(init_op)
+  return graph, model, init
+
+
+def measure(checkpoint, runs, intra, inter, cpus):
+  """Returns the p50 and p99 ms of sess.run with the given setting. Only
+  meaningful in a process that hasn't made a tensorflow session yet.
+  """
+  import numpy as np
+  import tensorflow as tf
+  graph, model, init = _load_model(tf, checkpoint)
+  rand = np.random.RandomState(1)
+  image = rand.randint(0, 256, (1, config.width * config.height * config.img_channels)).astype(np.float32)
+  feed_dict = {model.in_image: image, model.in_speed: np.zeros(1, dtype=np.float32)}
+  fetches = [model.steering_regress_result, model.throttle_regress_result]
+  sess = make_session(tf, graph, intra, inter, cpus)
+  init(sess)
+  for _ in range(10):
+    sess.run(fetches, feed_dict=feed_dict)
+  times = []
+  for _ in range(runs):
+    start = time.time()
+    sess.run(fetches, feed_dict=feed_dict)
+    times.append(time.time() - start)
+  sess.close()
+  times = np.array(times) * 1000.0
+  return np.percentile(times, 50), np.percentile(times, 99)
+
+
+def _measure_in_subprocess(checkpoint, runs, intra, inter, cpus, camera_args):
+  """Runs 'tune_threads.py measure' and returns its (p50, p99, camera fps), or None if it failed."""
+  command = [sys.executable, os.path.realpath(__file__), 'measure', str(intra), str(inter),
+             ','.join(str(cpu) for cpu in cpus) if cpus else 'all']
+  if checkpoint:
+    command.append(checkpoint)
+  command += ['--runs=%d' % runs] + camera_args
+  try:
+    output = subprocess.check_output(command, universal_newlines=True)
+  except subprocess.CalledProcessError as e:
+    print('measuring intra %d, inter %d, cpus %s failed with exit code %d' % (
+      intra, inter, cpus or 'all', e.returncode))
+    return None
+  for line in output.splitlines():
+    if line.startswith('result '):
+      return tuple(float(value) for value in line.split()[1:])
+  return None
+
+
+def tune(checkpoint, runs, camera_args=()):
+  """Times every setting in a process of its own and returns the best as
+  (p99, p50, intra, inter, cpus). camera_args are passed on to each one.
+  """
+  print('%6s %6s %-16s %9s %9s %11s' % ('intra', 'inter', 'cpus', 'p50 ms', 'p99 ms', 'camera fps'))
+  results = []
+  for intra, inter, cpus in _settings():
+    result = _measure_in_subprocess(checkpoint, runs, intra, inter, cpus, list(camera_args))
+    if result is None:
+      continue
+    p50, p99, fps = result
+    results.append((p99, p50, intra, inter, cpus))
+    print('%6d %6d %-16s %9.2f %9.2f %11.1f' % (intra, inter, cpus or 'all', p50, p99, fps))
+  if not results:
+    sys.exit('No setting could be timed.')
+  return min(results, key=lambda r: (r[0], r[1]))
+
+
+def write_local_config(settings, path=LOCAL_CONFIG):
+  """Sets the tf_* thread settings in local_config.py, keeping everything else."""
+  lines = []
+  if os.path.exists(path):
+    with open(path) as fp:
+      lines = [line for line in fp.read().splitlines()
+               if not re.match(r'(tf_intra_op_threads|tf_inter_op_threads|tf_cpu_affinity)\s*=', line)]
+    while lines and lines[-1].strip() in ('', '# Written by tune_threads.py'):
+      lines.pop()
+    if lines:
+      lines.append('')
+  lines.append('# Written by tune_threads.py')
+  for name, value in settings:
+    lines.append('%s = %r' % (name, value))
+  with open(path, 'w') as fp:
+    fp.write('\n'.join(lines) + '\n')
+
+
+def _start_camera(args):
+  if args['--no-camera']:
+    return None
+  import camera
+  if args['--replay']:
+    return camera.ReplayCameraStream(os.path.expanduser(args['--replay'])).start()
+  return camera.CameraStream(src=config.camera_id).start()
+
+
+if __name__ == '__main__':
+  from docopt import docopt
+  args = docopt(__doc__)
+  checkpoint = args['<checkpoint>'] and os.path.expanduser(args['<checkpoint>'])
+  runs = int(args['--runs'])
+  if args['measure']:
+    # One setting, with the camera capturing alongside in this process.
+    cpus = None if args['<cpus>'] == 'all' else [int(cpu) for cpu in args['<cpus>'].split(',')]
+    camera_stream = _start_camera(args)
+    p50, p99 = measure(checkpoint, runs, int(args['<intra>']), int(args['<inter>']), cpus)
+    fps = 0.0
+    if camera_stream is not None:
+      fps = camera_stream.fps()
+      camera_stream.stop()
+    print('result %f %f %f' % (p50, p99, fps))
+    sys.exit(0)
+
+  camera_args = []
+  if args['--no-camera']:
+    camera_args.append('--no-camera')
+  elif args['--replay']:
+    camera_args.append('--replay=%s' % args['--replay'])
+  p99, p50, intra, inter, cpus = tune(checkpoint, runs, camera_args)
+  print('best: intra %d, inter %d, cpus %s (p50 %.2f ms, p99 %.2f ms)' % (intra, inter, cpus or 'all', p50, p99))
+  if not args['--dry-run']:
+    write_local_config([('tf_intra_op_threads', intra), ('tf_inter_op_threads', inter),
+                        ('tf_cpu_affinity', list(cpus) if cpus else None)])
+    print('wrote %s' % LOCAL_CONFIG)